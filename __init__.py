@@ -5,6 +5,11 @@ from .company import *
 from .pos import *
 from .party import *
 from .address import *
+from .cae_queue import *
+from .qr_backfill import *
+from .padron import *
+from .activity import *
+from . import afip_ws
 
 def register():
     Pool.register(
@@ -14,13 +19,22 @@ def register():
         Invoice,
         Company,
         AfipWSTransaction,
+        CaeQueue,
+        QrBackfill,
+        AfipPadron,
+        AfipPadronEntry,
+        Activity,
         Party,
         Address,
         GetAFIPDataStart,
+        EnrichFromAFIPResult,
         module='account_invoice_ar', type_='model')
     Pool.register(
         GetAFIPData,
+        EnrichFromAFIP,
         module='account_invoice_ar', type_='wizard')
     Pool.register(
         InvoiceReport,
         module='account_invoice_ar', type_='report')
+    # parse (or download) the webservices WSDL before the first invoice
+    afip_ws.prewarm()
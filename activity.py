@@ -0,0 +1,82 @@
+#! -*- coding: utf8 -*-
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+
+import datetime
+
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.transaction import Transaction
+
+from . import activity_codes
+
+__all__ = ['Activity']
+
+
+class Activity(ModelSQL, ModelView):
+    'AFIP Activity'
+    __name__ = 'account_invoice_ar.activity'
+
+    code = fields.Char(u'Código', required=True, select=True, readonly=True)
+    description = fields.Char(u'Descripción', required=True, select=True,
+        readonly=True)
+    version = fields.Selection(activity_codes.VERSIONS, 'Nomenclador',
+        required=True, select=True, readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(Activity, cls).__setup__()
+        cls._order.insert(0, ('code', 'ASC'))
+        cls._sql_constraints += [
+            ('code_version_uniq', 'UNIQUE(code, version)',
+                'The activity code must be unique in each nomenclator.'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(Activity, cls).__register__(module_name)
+        cls._load_codes()
+
+    @classmethod
+    def _load_codes(cls):
+        "Insert the codes of the nomenclators missing from the table"
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        cursor.execute(*table.select(table.code, table.version))
+        existing = set(cursor.fetchall())
+        now = datetime.datetime.now()
+        values = [[code, description, version, 0, now]
+            for code, description, version in activity_codes.get_codes()
+            if (code, version) not in existing]
+        if values:
+            cursor.execute(*table.insert([table.code, table.description,
+                        table.version, table.create_uid, table.create_date],
+                    values))
+
+    @staticmethod
+    def default_version():
+        return activity_codes.CURRENT_VERSION
+
+    def get_rec_name(self, name):
+        return '%s - %s' % (self.code, self.description)
+
+    @classmethod
+    def search_rec_name(cls, name, clause):
+        "Prefix search on the code and the description"
+        value = clause[2]
+        if clause[1] not in ('like', 'ilike') or not isinstance(value,
+                basestring):
+            return [('code',) + tuple(clause[1:])]
+        value = value.strip('%')
+        return ['OR',
+            ('code', 'like', value + '%'),
+            ('description', 'ilike', value + '%'),
+            ]
+
+    @classmethod
+    def get_ids(cls, codes, version=None):
+        "Return {code: id} of the codes in the nomenclator (current one)"
+        activities = cls.search([
+                ('code', 'in', list(set(codes))),
+                ('version', '=', version or activity_codes.CURRENT_VERSION),
+                ])
+        return dict((a.code, a.id) for a in activities)
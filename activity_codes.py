@@ -0,0 +1,78 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the Affero GNU General Public License as published by
+# the Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+"AFIP activity codes of the nomenclators, loaded in account_invoice_ar.activity"
+
+__license__ = "AGPL 3.0"
+
+from . import actividades
+from . import afip_codigo_actividad
+
+
+# (version, label, codes): F.883 (CLAE, current) and F.150 (previous one)
+NOMENCLATORS = [
+    ('f883', u'F.883', actividades.CODES),
+    ('f150', u'F.150', afip_codigo_actividad.CODES),
+]
+VERSIONS = [(version, label) for version, label, _ in NOMENCLATORS]
+CURRENT_VERSION = 'f883'
+
+
+def get_codes():
+    "Yield (code, description, version) of all the nomenclators"
+    for version, _, codes in NOMENCLATORS:
+        for code, label in codes:
+            if not code:
+                continue
+            # u'011111 - Cultivo de arroz'
+            description = label.split(u' - ', 1)[-1]
+            yield code, description, version
+
+
+if __name__ == '__main__':
+    # benchmark (python -m trytond.modules.account_invoice_ar.activity_codes)
+    # field definitions of the party form (sent by fields_view_get)
+    # with the codes as selection and as Many2One, and validation of a code
+    import json
+    import sys
+    import timeit
+
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    selection = {
+        'type': 'selection', 'string': 'Primary Activity Code',
+        'selection': actividades.CODES, 'sort': True,
+        'states': '{"readonly": {"__class__": "Not", "v": {"__class__": '
+                  '"Eval", "v": "active", "d": true}}}',
+    }
+    many2one = {
+        'type': 'many2one', 'string': 'Primary Activity Code',
+        'relation': 'account_invoice_ar.activity',
+        'domain': '[["version", "=", "%s"]]' % CURRENT_VERSION,
+        'states': selection['states'],
+    }
+    for name, field in [('selection', selection), ('many2one', many2one)]:
+        # primary and secondary code on the party form
+        fields = {'primary_activity_code': field,
+                  'secondary_activity_code': field}
+        payload = json.dumps(fields)
+        seconds = timeit.timeit(lambda: json.loads(json.dumps(fields)),
+                                number=number)
+        print "%-10s %8d bytes %8.3f ms/view" % (name, len(payload),
+                                                 seconds * 1000 / number)
+
+    code = actividades.CODES[-1][0]
+    index = frozenset(c for c, _, v in get_codes() if v == CURRENT_VERSION)
+    seconds = timeit.timeit(lambda: code in dict(actividades.CODES),
+                            number=number)
+    print "validate selection %8.2f us" % (seconds * 1e6 / number)
+    seconds = timeit.timeit(lambda: code in index, number=number)
+    print "validate index     %8.2f us" % (seconds * 1e6 / number)
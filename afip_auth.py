@@ -23,24 +23,69 @@ __license__ = "AGPL 3.0"
 # Están muchos valores de importe con valor absoluto, puesto que el CAE
 # en AFIP no acepta valores negativos.
 
+import calendar
+import datetime
 import hashlib
+import tempfile
+import threading
 import time
 import os
 import sys
 import traceback
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None            # no inter-process lock (i.e. windows)
 
 
 DEFAULT_TTL = 60*60*5       # five hours
+EXPIRATION_MARGIN = 60      # clock skew tolerated against the ticket expiry
+REFRESH_RETRY = 60          # first wait between background renewal attempts
+REFRESH_MAX_RETRY = 60*15   # longest wait (it doubles after each failure)
 WSAA_URL = ""               # change to production server (testing default)
 PROXY = ""                  # proxy credentials and host
 CACHE = ""                  # cache folder path, use default
 DEBUG = False
 
+# parsed access tickets: md5 hash -> (token, sign, expiration timestamp)
+_tickets = {}
+# md5 hash -> (timestamp, timer) of the background renewal
+_timers = {}
+_tickets_lock = threading.Lock()
+
 
 def authenticate(service, certificate, private_key, force=False,
                  cache=CACHE, wsdl=WSAA_URL, proxy=PROXY, ):
     "Call AFIP Authentication webservice to get token & sign or error message"
 
+    # make md5 hash of the parameter for caching...
+    key = hashlib.md5(service + certificate + private_key).hexdigest()
+
+    # hot path: access ticket already parsed by this process
+    if not force:
+        ticket = get_ticket(key)
+        if ticket:
+            token, sign, expiration = ticket
+            return {'token': token, 'sign': sign, 'err_msg': None}
+
+    auth = _authenticate(key, service, certificate, private_key, force,
+        cache, wsdl, proxy)
+    if auth['token']:
+        # WSAA refuses a new ticket while the current one is valid
+        # ("El CEE ya posee un TA valido"), so renew it when it expires
+        ticket = get_ticket(key)
+        when = ticket[2] if ticket else time.time() + REFRESH_RETRY
+        schedule_refresh(key, (service, certificate, private_key, False,
+            cache, wsdl, proxy), when)
+    return auth
+
+
+def _authenticate(key, service, certificate, private_key, force=False,
+                  cache=CACHE, wsdl=WSAA_URL, proxy=PROXY):
+    "Get the access ticket from the file cache or login (one process at once)"
+
     # import AFIP webservice authentication helper:
     from pyafipws.wsaa import WSAA
 
@@ -48,54 +93,41 @@ def authenticate(service, certificate, private_key, force=False,
     wsaa = WSAA()
     wsaa.LanzarExcepciones = True       # raise python exceptions on any failure
 
-    # make md5 hash of the parameter for caching...
-    fn = "%s.xml" % hashlib.md5(service + certificate + private_key).hexdigest()
+    fn = "%s.xml" % key
     if cache:
         fn = os.path.join(cache, fn)
     else:
         fn = os.path.join(wsaa.InstallDir, "cache", fn)
 
     try:
-        # read the access ticket (if already authenticated)
-        if not os.path.exists(fn) or \
-           os.path.getmtime(fn)+(DEFAULT_TTL) < time.time():
-            # access ticket (TA) outdated, create new access request ticket (TRA)
-            tra = wsaa.CreateTRA(service=service, ttl=DEFAULT_TTL)
-            # cryptographically sing the access ticket
-            cms = wsaa.SignTRA(tra, certificate, private_key)
-            # connect to the webservice:
-            wsaa.Conectar(cache, wsdl, proxy)
-            # call the remote method
-            ta = wsaa.LoginCMS(cms)
-            if not ta:
-                raise RuntimeError()
-            # write the access ticket for further consumption
-            open(fn, "w").write(ta)
-        else:
-            # get the access ticket from the previously written file
-            ta = open(fn, "r").read()
-        # force to connect against WSAA
-        if force:
-            tra = None
-            cms = None
-            ta = None
-            tra = wsaa.CreateTRA(service=service, ttl=DEFAULT_TTL)
-            # cryptographically sing the access ticket
-            cms = wsaa.SignTRA(tra, certificate, private_key)
-            # connect to the webservice:
-            wsaa.Conectar(cache, wsdl, proxy)
-            # call the remote method
-            ta = wsaa.LoginCMS(cms)
-            if not ta:
-                raise RuntimeError()
-            # write the access ticket for further consumption
-            open(fn, "w").write(ta)
+        # only one process logs in, the others wait and reuse its ticket
+        with file_lock(fn):
+            # read the access ticket (if already authenticated)
+            ta, expiration = read_ticket(wsaa, fn)
+            if force or ta is None or expiration <= time.time():
+                # access ticket (TA) outdated, create new access request ticket (TRA)
+                try:
+                    new_ta = login(wsaa, service, certificate, private_key,
+                        cache, wsdl, proxy)
+                except Exception:
+                    # WSAA refuses a new ticket while the current is valid,
+                    # keep using it if the clocks differ (up to the margin)
+                    if (force or ta is None
+                            or expiration + EXPIRATION_MARGIN < time.time()):
+                        raise
+                else:
+                    # write the access ticket for further consumption
+                    write_file(fn, new_ta)
+                    ta = new_ta
+                    expiration = get_expiration(wsaa, ta,
+                        default=time.time() + DEFAULT_TTL)
         # analyze the access ticket xml and extract the relevant fields
         wsaa.AnalizarXml(xml=ta)
         token = wsaa.ObtenerTagXml("token")
         print "token", token
         sign = wsaa.ObtenerTagXml("sign")
         print "sign", sign
+        set_ticket(key, token, sign, expiration)
         err_msg = None
     except:
         token = sign = None
@@ -111,6 +143,137 @@ def authenticate(service, certificate, private_key, force=False,
     return {'token': token, 'sign': sign, 'err_msg': err_msg}
 
 
+def login(wsaa, service, certificate, private_key, cache, wsdl, proxy):
+    "Call the WSAA LoginCMS method, returns the access ticket xml"
+    tra = wsaa.CreateTRA(service=service, ttl=DEFAULT_TTL)
+    # cryptographically sing the access ticket
+    cms = wsaa.SignTRA(tra, certificate, private_key)
+    # connect to the webservice (keep the parsed WSDL in the module cache):
+    wsaa.Conectar(cache or get_cache_dir(), wsdl, proxy)
+    # call the remote method
+    ta = wsaa.LoginCMS(cms)
+    if not ta:
+        raise RuntimeError()
+    return ta
+
+
+def schedule_refresh(key, args, when, retry=0):
+    """Renew the access ticket in a thread at the timestamp (once per key).
+
+    The file lock of _authenticate lets only one process log in, the others
+    read its ticket; a failed login is retried, waiting twice as long.
+    """
+    with _tickets_lock:
+        current = _timers.get(key)
+        if current is not None:
+            if current[0] == when and current[1].is_alive():
+                return
+            if current[1] is not threading.current_thread():
+                current[1].cancel()
+        timer = threading.Timer(max(when - time.time(), 0), _refresh,
+            (key, args, retry))
+        timer.daemon = True
+        _timers[key] = (when, timer)
+    timer.start()
+
+
+def _refresh(key, args, retry):
+    "Log in again when the access ticket expired (background thread)"
+    auth = _authenticate(key, *args)
+    ticket = get_ticket(key)
+    if auth['token'] and ticket and ticket[2] > time.time():
+        schedule_refresh(key, args, ticket[2])
+    else:
+        delay = min(REFRESH_RETRY * 2 ** retry, REFRESH_MAX_RETRY)
+        schedule_refresh(key, args, time.time() + delay, retry + 1)
+
+
+@contextmanager
+def file_lock(fn):
+    "Hold an exclusive advisory lock of the access ticket file"
+    if fcntl is None:
+        yield
+        return
+    with open(fn + ".lock", "a") as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+def read_ticket(wsaa, fn):
+    "Return the access ticket xml and its expiration from the file cache"
+    if not os.path.exists(fn):
+        return None, None
+    ta = open(fn, "r").read()
+    if not ta:
+        return None, None
+    return ta, get_expiration(wsaa, ta,
+        default=os.path.getmtime(fn) + DEFAULT_TTL)
+
+
+def write_file(fn, data):
+    "Write the file atomically (write a temporary file and rename)"
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fn), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, fn)
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def get_ticket(key):
+    "Return (token, sign, expiration) of the parsed access ticket if valid"
+    with _tickets_lock:
+        ticket = _tickets.get(key)
+        if ticket is None:
+            return None
+        if ticket[2] <= time.time():
+            del _tickets[key]
+            return None
+        return ticket
+
+
+def set_ticket(key, token, sign, expiration):
+    "Keep the parsed access ticket in memory until its expiration"
+    with _tickets_lock:
+        _tickets[key] = (token, sign, expiration)
+
+
+def get_expiration(wsaa, ta, default=None):
+    "Return the expirationTime of the access ticket as a timestamp"
+    wsaa.AnalizarXml(xml=ta)
+    value = wsaa.ObtenerTagXml("expirationTime")
+    if not value:
+        return default
+    try:
+        return parse_datetime(value)
+    except ValueError:
+        return default
+
+
+def parse_datetime(value):
+    "Convert a xsd:dateTime (2013-05-23T21:43:17.871-03:00) to a timestamp"
+    value = value.strip()
+    offset = 0
+    if value.endswith('Z'):
+        value = value[:-1]
+    elif len(value) > 6 and value[-6] in '+-' and value[-3] == ':':
+        offset = int(value[-5:-3]) * 3600 + int(value[-2:]) * 60
+        if value[-6] == '-':
+            offset = -offset
+        value = value[:-6]
+    value = value.split('.')[0]
+    date = datetime.datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+    return calendar.timegm(date.timetuple()) - offset
+
+
 def get_cache_dir():
     return os.path.join(get_account_invoice_install_dir(), 'cache')
 
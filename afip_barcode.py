@@ -0,0 +1,69 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the Affero GNU General Public License as published by
+# the Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+"Interleaved 2 of 5 barcode of electronic invoices (CAE), rendered once"
+
+__license__ = "AGPL 3.0"
+
+import threading
+from cStringIO import StringIO
+
+from .image_cache import ImageCache
+
+
+CACHE_SIZE = 256            # images kept in memory (least recently used)
+CACHE_DIR = None            # folder to keep the rendered images (optional)
+
+_images = ImageCache(CACHE_SIZE)
+_pyi25 = None
+_pyi25_lock = threading.Lock()
+
+
+def get_helper():
+    "Return the PyI25 helper of the process (created once)"
+    global _pyi25
+    with _pyi25_lock:
+        if _pyi25 is None:
+            from pyafipws.pyi25 import PyI25
+            _pyi25 = PyI25()
+        return _pyi25
+
+
+def render(bars):
+    "Return the PNG image of the barcode (digits only)"
+    output = StringIO()
+    get_helper().GenerarImagen(bars, output, basewidth=3, width=380,
+                               height=50, extension="PNG")
+    image = output.getvalue()
+    output.close()
+    return image
+
+
+def get_image(barcode):
+    "Return the image of the barcode, memoized by its digits"
+    bars = ''.join([c for c in barcode if c.isdigit()])
+    if not bars:
+        bars = "00"
+    return _images.get(bars, lambda: render(bars), CACHE_DIR)
+
+
+if __name__ == '__main__':
+    # benchmark (python -m trytond.modules.account_invoice_ar.afip_barcode)
+    # cost of the barcode of an invoice
+    import sys
+    import timeit
+    barcode = "30000000007010001234567890123420201023"
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    seconds = timeit.timeit(lambda: render(barcode), number=number)
+    print "render   %8.2f ms/invoice" % (seconds * 1000 / number)
+    seconds = timeit.timeit(lambda: get_image(barcode), number=number)
+    print "memoized %8.2f ms/invoice" % (seconds * 1000 / number)
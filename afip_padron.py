@@ -0,0 +1,316 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the Affero GNU General Public License as published by
+# the Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+"Lookup of the AFIP padron (taxpayer data by CUIT) with keep-alive and cache"
+
+__license__ = "AGPL 3.0"
+
+import collections
+import httplib
+import json
+import socket
+import threading
+import time
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+
+URL = "https://soa.afip.gob.ar/sr-padron/v2/persona/%s"
+TIMEOUT = 10                # seconds to connect and to wait for each response
+POOL_SIZE = 4               # idle connections kept for each host
+TTL = 24*60*60              # seconds a taxpayer is kept
+NOT_FOUND_TTL = 60*60       # seconds a CUIT not found is kept (negative cache)
+CACHE_SIZE = 1024           # taxpayers kept in memory (least recently used)
+MAX_WORKERS = 4             # concurrent requests of lookup_many
+RATE_LIMIT = 5              # requests per second of lookup_many
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class PadronError(Exception):
+    "The padron could not be queried (network or server error), not cached"
+
+
+class ConnectionPool(object):
+    "Persistent (keep-alive) HTTP connections, reused by host"
+
+    def __init__(self, size=POOL_SIZE, timeout=TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _get_connection(self, scheme, netloc):
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop(), True
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        else:
+            connection = httplib.HTTPConnection(netloc, timeout=self.timeout)
+        return connection, False
+
+    def _release(self, scheme, netloc, connection):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def get(self, url):
+        "Return the status and body of the GET request"
+        scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+        if query:
+            path += '?' + query
+        while True:
+            connection, reused = self._get_connection(scheme, netloc)
+            try:
+                connection.request('GET', path, headers={
+                        'Accept': 'application/json',
+                        'Connection': 'keep-alive',
+                        })
+                response = connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error), e:
+                connection.close()
+                if reused:
+                    # the server closed the idle connection, use a new one
+                    continue
+                raise PadronError(unicode(e))
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(scheme, netloc, connection)
+            return response.status, body
+
+    def clear(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for connection in idle:
+                    connection.close()
+            self._idle.clear()
+
+
+class ResponseCache(object):
+    "Taxpayers by CUIT (None when not found) kept in memory until they expire"
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cuit):
+        "Return (hit, data), data is None for a CUIT not found"
+        with self._lock:
+            entry = self._entries.pop(cuit, None)
+            if entry is None or entry[0] < time.time():
+                return False, None
+            self._entries[cuit] = entry
+            return True, entry[1]
+
+    def set(self, cuit, data, ttl=None):
+        if ttl is None:
+            ttl = TTL if data is not None else NOT_FOUND_TTL
+        with self._lock:
+            self._entries.pop(cuit, None)
+            self._entries[cuit] = (time.time() + ttl, data)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RateLimiter(object):
+    "Spread the requests of all the threads: at most rate per second"
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+_cache = ResponseCache(CACHE_SIZE)
+
+
+def get_pool():
+    "Return the connection pool of the process (created on first use)"
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(POOL_SIZE, TIMEOUT)
+        return _pool
+
+
+def normalize(cuit):
+    return ''.join([c for c in unicode(cuit or '') if c.isdigit()])
+
+
+def fetch(cuit, url=None):
+    "Query the padron, return the taxpayer data or None if it does not exist"
+    status, body = get_pool().get((url or URL) % cuit)
+    if status == 404:
+        return None
+    if status != 200:
+        raise PadronError(u"HTTP %s" % status)
+    try:
+        response = json.loads(body)
+    except ValueError, e:
+        raise PadronError(unicode(e))
+    if not response.get('success') or not response.get('data'):
+        return None
+    return response['data']
+
+
+def get_cached(cuit):
+    "Return (hit, data) from the memory cache"
+    return _cache.get(normalize(cuit))
+
+
+def remember(cuit, data, ttl=None):
+    "Keep the taxpayer data (or None if not found) in the memory cache"
+    _cache.set(normalize(cuit), data, ttl)
+
+
+def lookup(cuit, url=None):
+    "Return the taxpayer data of the CUIT (None if not found), cached"
+    cuit = normalize(cuit)
+    hit, data = _cache.get(cuit)
+    if not hit:
+        data = fetch(cuit, url)
+        _cache.set(cuit, data)
+    return data
+
+
+def lookup_many(cuits, url=None, workers=MAX_WORKERS, rate=RATE_LIMIT):
+    '''Return {cuit: data} of the CUITs, cached like lookup.
+
+    data is None if the CUIT does not exist and the PadronError if it could
+    not be queried; at most workers requests at once and rate per second.
+    '''
+    limiter = RateLimiter(rate)
+
+    def lookup_one(cuit):
+        hit, data = _cache.get(cuit)
+        if hit:
+            return data
+        limiter.wait()
+        try:
+            data = fetch(cuit, url)
+        except PadronError, e:
+            return e
+        _cache.set(cuit, data)
+        return data
+
+    cuits = list(set(normalize(c) for c in cuits))
+    if not cuits:
+        return {}
+    threads = ThreadPool(min(workers, len(cuits)))
+    try:
+        return dict(zip(cuits, threads.map(lookup_one, cuits)))
+    finally:
+        threads.close()
+        threads.join()
+
+
+def clear():
+    _cache.clear()
+    with _pool_lock:
+        if _pool is not None:
+            _pool.clear()
+
+
+if __name__ == '__main__':
+    # benchmark against a local stub of the padron: a new connection for each
+    # request (urlopen, as the wizard did), the keep-alive pool and the cache
+    import sys
+    import timeit
+    import urllib2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        wbufsize = -1       # one send for each response (no Nagle delay)
+
+        def do_GET(self):
+            cuit = self.path.rsplit('/', 1)[-1]
+            if cuit.startswith('20'):
+                status, response = 200, {'success': True, 'data': {
+                    'idPersona': int(cuit), 'nombre': 'CONTRIBUYENTE %s' % cuit,
+                    'estadoClave': 'ACTIVO', 'actividades': [620100],
+                    'domicilioFiscal': {'direccion': 'CALLE 1',
+                                        'codPostal': '1000'},
+                    'fechaInscripcion': '2010-01-01'}}
+            else:
+                status, response = 404, {'success': False}
+            body = json.dumps(response)
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class StubServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:%d/sr-padron/v2/persona/%%s" % server.server_port
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    cuits = ['20%09d' % (i % 50) for i in range(number)]
+
+    def new_connection():
+        for cuit in cuits:
+            try:
+                json.loads(urllib2.urlopen(url % cuit).read())
+            except urllib2.HTTPError:
+                pass
+
+    def pooled():
+        for cuit in cuits:
+            fetch(cuit, url)
+
+    def cached():
+        for cuit in cuits:
+            lookup(cuit, url)
+
+    def concurrent():
+        _cache.clear()
+        lookup_many(cuits, url, rate=0)
+
+    for name, function in [('urlopen', new_connection), ('keep-alive', pooled),
+                           ('cached', cached), ('lookup_many', concurrent)]:
+        seconds = timeit.timeit(function, number=1)
+        print "%-12s %8.3f ms/lookup" % (name, seconds * 1000 / number)
+    assert lookup('20000000001', url)['nombre'] == 'CONTRIBUYENTE 20000000001'
+    assert lookup('30000000001', url) is None
+    assert get_cached('30000000001') == (True, None)
+    clear()
+    server.shutdown()
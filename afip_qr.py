@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the Affero GNU General Public License as published by
+# the Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+"QR code of electronic invoices (RG AFIP 4892), rendered in memory"
+
+__license__ = "AGPL 3.0"
+
+import base64
+import collections
+import hashlib
+import io
+import json
+from decimal import Decimal
+
+from .image_cache import ImageCache
+
+
+URL = "https://www.afip.gob.ar/fe/qr/?p="
+# payload fields, in the order of the specification
+FIELDS = ('ver', 'fecha', 'cuit', 'ptoVta', 'tipoCmp', 'nroCmp', 'importe',
+          'moneda', 'ctz', 'tipoDocRec', 'nroDocRec', 'tipoCodAut', 'codAut')
+FORMATS = ('png', 'svg')
+FORMAT = 'png'              # 1-bit png, the smallest (svg scales better)
+SCALE = 1                   # pixels per module, the report scales the image
+ERROR = 'L'                 # error correction level
+CACHE_SIZE = 256            # images kept in memory (least recently used)
+CACHE_DIR = None            # folder to keep the rendered images (optional)
+
+_images = ImageCache(CACHE_SIZE)
+
+
+def encode(data):
+    """Return the payload (compact JSON) and the url of the QR code.
+
+    data is a dict with the FIELDS of the specification, the missing (or
+    None) ones are left out. The payload is encoded in URL-safe base64,
+    without line breaks.
+    """
+    values = collections.OrderedDict()
+    for name in FIELDS:
+        value = data.get(name)
+        if value is None:
+            continue
+        if isinstance(value, Decimal):
+            if value == value.to_integral_value():
+                value = int(value)
+            else:
+                value = float(value)
+        values[name] = value
+    payload = json.dumps(values, separators=(',', ':'))
+    return payload, URL + base64.urlsafe_b64encode(payload)
+
+
+def render(text, fmt=FORMAT, version=None, scale=SCALE, error=ERROR):
+    """Return the image (png or svg data) of the QR code of the text.
+
+    Black and white PNGs are written by pyqrcode with a bit depth of 1 (one
+    bit per pixel), one pixel per module; SVG suits vector outputs.
+    """
+    import pyqrcode
+    if fmt not in FORMATS:
+        raise ValueError("Formato no soportado: %s" % fmt)
+    qr = pyqrcode.create(text, error=error, version=version, mode='binary')
+    stream = io.BytesIO()
+    if fmt == 'svg':
+        qr.svg(stream, scale=scale, xmldecl=False, omithw=True)
+    else:
+        qr.png(stream, scale=scale)
+    return stream.getvalue()
+
+
+
+def get_image(text, fmt=FORMAT, version=None):
+    """Return the image of the QR code of the text, rendering it only once.
+
+    The images are memoized by the hash of the payload, in memory (bounded
+    LRU) and, if CACHE_DIR is set, on disk (shared by the worker processes).
+    """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    key = "%s-%s-%s" % (hashlib.sha1(text).hexdigest(), version or 0, fmt)
+    return _images.get(key, lambda: render(text, fmt, version), CACHE_DIR,
+                       fmt)
+
+
+if __name__ == '__main__':
+    # benchmark (python -m trytond.modules.account_invoice_ar.afip_qr)
+    # cost of the QR code of an invoice
+    import sys
+    import timeit
+    data = {'ver': 1, 'fecha': '2020-10-13', 'cuit': 30000000007,
+            'ptoVta': 10, 'tipoCmp': 1, 'nroCmp': 94,
+            'importe': Decimal('12100.00'), 'moneda': 'PES', 'ctz': 1,
+            'tipoDocRec': 80, 'nroDocRec': 20000000001, 'tipoCodAut': 'E',
+            'codAut': 70417054367476}
+    payload, text = encode(data)
+    print payload
+    print text
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    seconds = timeit.timeit(lambda: encode(data), number=number * 100)
+    print "encode           %8.3f ms/invoice %6d chars" % (
+        seconds * 1000 / number / 100, len(text))
+    for fmt, version in [('png', 13), ('png', None), ('svg', None)]:
+        seconds = timeit.timeit(lambda: render(text, fmt, version),
+                                number=number)
+        print "%s version %-4s %8.2f ms/invoice %6d bytes" % (
+            fmt, version or 'auto', seconds * 1000 / number,
+            len(render(text, fmt, version)))
+    seconds = timeit.timeit(lambda: get_image(text), number=number)
+    print "memoized         %8.2f ms/invoice" % (seconds * 1000 / number)
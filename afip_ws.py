@@ -0,0 +1,254 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the Affero GNU General Public License as published by
+# the Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+"Pool of connected clients for Argentina's Federal Tax Agency (AFIP) webservices"
+
+__license__ = "AGPL 3.0"
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+from . import afip_auth
+
+
+WSDL = {
+    ('wsfe', 'homologacion'):
+        "https://wswhomo.afip.gov.ar/wsfev1/service.asmx?WSDL",
+    ('wsfe', 'produccion'):
+        "https://servicios1.afip.gov.ar/wsfev1/service.asmx?WSDL",
+    ('wsfex', 'homologacion'):
+        "https://wswhomo.afip.gov.ar/wsfexv1/service.asmx?WSDL",
+    ('wsfex', 'produccion'):
+        "https://servicios1.afip.gov.ar/wsfexv1/service.asmx?WSDL",
+    ('wsaa', 'homologacion'):
+        "https://wsaahomo.afip.gov.ar/ws/services/LoginCms?wsdl",
+    ('wsaa', 'produccion'):
+        "https://wsaa.afip.gov.ar/ws/services/LoginCms?wsdl",
+}
+SERVICES = ('wsfe', 'wsfex')
+MODES = ('homologacion', 'produccion')
+MAX_IDLE = 4                # idle clients kept for each (company, service, mode)
+MANIFEST = "wsdl.json"      # content hash of the cached WSDL files
+
+_lock = threading.Lock()
+_idle = {}
+# clients connected in advance, not bound to a company: (service, mode) -> list
+_warm = {}
+# WSDL urls whose cached files were already checked by this process
+_checked = set()
+
+
+def create_client(service, mode):
+    "Create a new webservice helper and connect it (parse the WSDL)"
+    if service == 'wsfe':
+        from pyafipws.wsfev1 import WSFEv1  # local market
+        ws = WSFEv1()
+    elif service == 'wsfex':
+        from pyafipws.wsfexv1 import WSFEXv1  # foreign trade
+        ws = WSFEXv1()
+    else:
+        raise ValueError("WS no soportado: %s" % service)
+    ws.LanzarExcepciones = True
+    wsdl = WSDL.get((service, mode))
+    connect(ws, wsdl)
+    return ws
+
+
+def connect(ws, wsdl):
+    """Connect the helper, loading the parsed WSDL from the module cache.
+
+    The WSDL is downloaded and parsed only once (pysimplesoap pickles it in
+    the cache folder); damaged files are dropped so they are downloaded again.
+    """
+    cache = afip_auth.get_cache_dir()
+    if wsdl:
+        check_wsdl_cache(wsdl)
+    ws.Conectar(cache=cache, wsdl=wsdl)
+    if wsdl:
+        record_wsdl_cache(wsdl)
+
+
+def get_wsdl_cache_files(wsdl):
+    "Return the names of the cached files of the WSDL (raw xml and pickle)"
+    name = hashlib.md5(wsdl).hexdigest()
+    return [name + ".xml", name + ".pkl"]
+
+
+def file_digest(fn):
+    with open(fn, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def read_manifest(fn):
+    try:
+        with open(fn, "r") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def check_wsdl_cache(wsdl):
+    "Remove the cached files of the WSDL that do not match their hash"
+    if wsdl in _checked:
+        return
+    cache = afip_auth.get_cache_dir()
+    manifest = read_manifest(os.path.join(cache, MANIFEST))
+    for name in get_wsdl_cache_files(wsdl):
+        fn = os.path.join(cache, name)
+        if not os.path.exists(fn):
+            continue
+        digest = manifest.get(name)
+        if digest and digest != file_digest(fn):
+            logging.getLogger('pyafipws').warning(
+                u'WSDL en cache dañado, se descarga nuevamente: %s', wsdl)
+            os.unlink(fn)
+
+
+def record_wsdl_cache(wsdl):
+    "Store the hash of the cached files of the WSDL once they were loaded"
+    cache = afip_auth.get_cache_dir()
+    fn = os.path.join(cache, MANIFEST)
+    with afip_auth.file_lock(fn):
+        manifest = read_manifest(fn)
+        changed = False
+        for name in get_wsdl_cache_files(wsdl):
+            path = os.path.join(cache, name)
+            if not os.path.exists(path):
+                continue
+            digest = file_digest(path)
+            if manifest.get(name) != digest:
+                manifest[name] = digest
+                changed = True
+        if changed:
+            afip_auth.write_file(fn, json.dumps(manifest, indent=1,
+                sort_keys=True))
+    _checked.add(wsdl)
+
+
+def prewarm(modes=MODES):
+    """Load (or download) the WSDL of every service and mode in background.
+
+    One connected client of each service and mode is kept, so the first
+    invoice posted by the process does not wait for it.
+    """
+    def warm():
+        logger = logging.getLogger('pyafipws')
+        for mode in modes:
+            for service in SERVICES:
+                try:
+                    ws = create_client(service, mode)
+                except Exception:
+                    logger.debug(u'No se pudo conectar %s (%s)', service, mode,
+                        exc_info=True)
+                    continue
+                with _lock:
+                    _warm.setdefault((service, mode), []).append(ws)
+            try:
+                from pyafipws.wsaa import WSAA
+                connect(WSAA(), WSDL[('wsaa', mode)])
+            except Exception:
+                logger.debug(u'No se pudo conectar wsaa (%s)', mode,
+                    exc_info=True)
+    thread = threading.Thread(target=warm)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def reset_client(ws):
+    "Clear the invoice data and results left by the previous use"
+    if hasattr(ws, 'inicializar'):
+        ws.inicializar()
+    ws.factura = None
+    ws.facturas = []
+    ws.Excepcion = ws.Traceback = ""
+    ws.XmlRequest = ws.XmlResponse = ""
+
+
+def acquire(company, service, mode, cuit, token, sign):
+    "Return a connected client for the company, service and mode"
+    key = (company, service, mode)
+    ws = None
+    with _lock:
+        idle = _idle.get(key, [])
+        while idle and ws is None:
+            ws = idle.pop()
+            if (ws.Token, ws.Sign) != (token, sign):
+                # the access ticket was renewed, rebuild the client
+                ws = None
+        if ws is None and _warm.get((service, mode)):
+            ws = _warm[(service, mode)].pop()
+    if ws is None:
+        ws = create_client(service, mode)
+    else:
+        reset_client(ws)
+    # set AFIP webservice credentials:
+    ws.Cuit = cuit
+    ws.Token = token
+    ws.Sign = sign
+    return ws
+
+
+def release(company, service, mode, ws, discard=False):
+    "Give the client back to the pool (discard it if it failed)"
+    if discard or ws.Excepcion:
+        return
+    key = (company, service, mode)
+    with _lock:
+        idle = _idle.setdefault(key, [])
+        if len(idle) < MAX_IDLE:
+            idle.append(ws)
+
+
+@contextmanager
+def checkout(company, service, mode, cuit, token, sign):
+    """Yield a connected client for the company, service and mode.
+
+    The client is given back to the pool when the block ends, unless it
+    raised an exception or the helper recorded one (ws.Excepcion): in that
+    case it is discarded and a new one is built on the next checkout.
+    """
+    ws = acquire(company, service, mode, cuit, token, sign)
+    try:
+        yield ws
+    except:
+        release(company, service, mode, ws, discard=True)
+        raise
+    release(company, service, mode, ws)
+
+
+class Result(object):
+    "Copy of the results of a webservice call, to be stored later"
+    __slots__ = ('Cuit', 'CAE', 'Vencimiento', 'Resultado', 'Obs', 'ErrMsg',
+        'XmlRequest', 'XmlResponse', 'msg', 'batch')
+
+    def __init__(self, ws, msg=None, batch=None):
+        """batch identifies the request of many vouchers (the XML payloads
+        are the same for all of them, they are logged once)"""
+        for name in self.__slots__[:-2]:
+            setattr(self, name, getattr(ws, name, None))
+        if msg is None:
+            msg = u"\n".join([ws.Obs or "", ws.ErrMsg or ""])
+        self.msg = msg
+        self.batch = batch
+
+
+def clear(company=None):
+    "Drop the idle clients (of a company, or all of them)"
+    with _lock:
+        for key in _idle.keys():
+            if company is None or key[0] == company:
+                del _idle[key]
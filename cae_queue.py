@@ -0,0 +1,291 @@
+#! -*- coding: utf8 -*-
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+
+import collections
+import datetime
+import logging
+import uuid
+
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pyson import Eval
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = ['CaeQueue']
+
+MAX_ATTEMPTS = 8            # then the entry is left as failed
+MAX_BACKOFF = 60*60         # seconds between attempts, at most one hour
+CLAIM_TIMEOUT = 30*60       # seconds until the entries of a dead worker return
+
+
+class CaeQueue(ModelSQL, ModelView):
+    'Pending CAE Queue'
+    __name__ = 'account_invoice_ar.cae_queue'
+
+    invoice = fields.Many2One('account.invoice', 'Invoice', required=True,
+        ondelete='CASCADE', select=True, readonly=True)
+    pos = fields.Many2One('account.pos', 'Point of Sale', required=True,
+        select=True, readonly=True)
+    invoice_type = fields.Many2One('account.pos.sequence', 'Invoice Type',
+        required=True, readonly=True)
+    state = fields.Selection([
+            ('pending', 'Pendiente'),
+            ('processing', 'Procesando'),
+            ('done', 'Autorizada'),
+            ('failed', 'Fallida'),
+            ('blocked', 'Bloqueada'),
+            ], 'Estado', required=True, select=True, readonly=True,
+        help=u'Una factura fallida detiene su punto de venta y tipo de '
+        u'comprobante: las siguientes quedan bloqueadas hasta reintentarla.')
+    claim = fields.Char('Reclamo', readonly=True, select=True)
+    attempts = fields.Integer('Intentos', readonly=True)
+    next_attempt = fields.DateTime(u'Próximo intento', readonly=True)
+    authorized_at = fields.DateTime('Autorizada', readonly=True)
+    latency = fields.Function(fields.Float('Demora (segundos)', digits=(16, 0)),
+        'get_latency')
+
+    @classmethod
+    def __setup__(cls):
+        super(CaeQueue, cls).__setup__()
+        cls._order.insert(0, ('id', 'ASC'))
+        cls._buttons.update({
+            'retry': {
+                'invisible': Eval('state') != 'failed',
+                },
+            })
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    def get_latency(self, name):
+        end = self.authorized_at or datetime.datetime.now()
+        return (end - self.create_date).total_seconds()
+
+    @classmethod
+    def enqueue(cls, invoices):
+        "Add the posted invoices to the queue, waiting for their CAE"
+        if not invoices:
+            return []
+        return cls.create([{
+                    'invoice': invoice.id,
+                    'pos': invoice.pos.id,
+                    'invoice_type': invoice.invoice_type.id,
+                    } for invoice in invoices])
+
+    @classmethod
+    def _stream_domain(cls, entry):
+        return [
+            ('pos', '=', entry.pos.id),
+            ('invoice_type', '=', entry.invoice_type.id),
+            ]
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, entries):
+        "Retry the failed entries and release the ones blocked behind them"
+        blocked = []
+        for entry in entries:
+            blocked.extend(cls.search(cls._stream_domain(entry) + [
+                        ('state', '=', 'blocked'),
+                        ]))
+        cls.write(list(entries) + blocked, {
+                'state': 'pending',
+                'attempts': 0,
+                'next_attempt': None,
+                })
+
+    @classmethod
+    def process(cls):
+        '''
+        Request the CAE of the pending invoices (cron).
+        Each point of sale and invoice type is an independent stream,
+        processed in invoice number order and committed batch by batch.
+        '''
+        cls._release_stale()
+        now = datetime.datetime.now()
+        entries = cls.search([
+                ('state', '=', 'pending'),
+                ['OR',
+                    ('next_attempt', '=', None),
+                    ('next_attempt', '<=', now),
+                    ],
+                ])
+        streams = collections.OrderedDict()
+        for entry in entries:
+            streams.setdefault((entry.pos.id, entry.invoice_type.id), entry)
+        for entry in streams.itervalues():
+            cls._process_stream(entry)
+        cls.log_metrics()
+
+    @classmethod
+    def _release_stale(cls):
+        "Return to pending the entries claimed by a worker that died"
+        limit = datetime.datetime.now() - datetime.timedelta(
+            seconds=CLAIM_TIMEOUT)
+        stale = cls.search([
+                ('state', '=', 'processing'),
+                ('write_date', '<', limit),
+                ])
+        if stale:
+            cls.write(stale, {
+                    'state': 'pending',
+                    'claim': None,
+                    })
+            Transaction().cursor.commit()
+
+    @classmethod
+    def _claim(cls, entries):
+        '''
+        Mark the pending entries as processing (only the ones no other worker
+        took) and commit, so AFIP is called without holding any lock.
+        Return the entries claimed.
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        claim = uuid.uuid4().hex
+        ids = [e.id for e in entries]
+        for i in range(0, len(ids), cursor.IN_MAX):
+            cursor.execute(*table.update(
+                    [table.state, table.claim, table.write_uid,
+                        table.write_date],
+                    ['processing', claim, Transaction().user,
+                        datetime.datetime.now()],
+                    where=table.id.in_(ids[i:i + cursor.IN_MAX])
+                    & (table.state == 'pending')))
+        cursor.commit()
+        return cls.search([('claim', '=', claim)])
+
+    @classmethod
+    def _process_stream(cls, entry):
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        logger = logging.getLogger('pyafipws')
+
+        # a failed entry stops its stream: the next numbers can not be sent
+        if cls.search(cls._stream_domain(entry) + [
+                    ('state', '=', 'failed'),
+                    ], limit=1):
+            cls.write(cls.search(cls._stream_domain(entry) + [
+                        ('state', '=', 'pending'),
+                        ]), {
+                    'state': 'blocked',
+                    })
+            Transaction().cursor.commit()
+            return
+        entries = cls.search(cls._stream_domain(entry) + [
+                ('state', '=', 'pending'),
+                ])
+        entries.sort(key=lambda e: e.invoice.number)
+        # the first number waits for its attempt, the next ones behind it
+        now = datetime.datetime.now()
+        if not entries or (entries[0].next_attempt
+                and entries[0].next_attempt > now):
+            return
+        entries = cls._claim(entries)
+        if not entries:
+            return
+        entries.sort(key=lambda e: e.invoice.number)
+        invoices = [e.invoice for e in entries]
+        with Transaction().set_context(company=invoices[0].company.id):
+            try:
+                Invoice.do_pyafipws_request_cae_batch(invoices)
+            except Exception:
+                logger.exception(u'Error solicitando CAE en cola: %s',
+                    ', '.join(i.number for i in invoices))
+                # discard what the failed request did and read again in a
+                # new snapshot: the CAEs granted meanwhile are only in the
+                # AFIP transactions log (committed apart), store them
+                Transaction().cursor.rollback()
+                entries = cls.browse([e.id for e in entries])
+                invoices = Invoice.browse([e.invoice.id for e in entries])
+                Invoice.pyafipws_reconcile(invoices)
+
+            done, pending = [], []
+            for entry, invoice in zip(entries, invoices):
+                invoice = Invoice(invoice.id)
+                if invoice.pyafipws_cae:
+                    invoice.crear_codigo_qr()
+                    done.append(entry)
+                else:
+                    pending.append(entry)
+        if done:
+            cls.write(done, {
+                    'state': 'done',
+                    'claim': None,
+                    'authorized_at': datetime.datetime.now(),
+                    })
+        if pending:
+            cls._postpone(pending)
+        Transaction().cursor.commit()
+
+    @classmethod
+    def _postpone(cls, entries):
+        '''
+        Schedule a new attempt of the stream with exponential backoff.
+        Only the first entry counts the attempt (the next numbers depend on
+        it), when it fails for good the next ones are blocked.
+        '''
+        first, rest = entries[0], entries[1:]
+        attempts = first.attempts + 1
+        if attempts >= MAX_ATTEMPTS:
+            cls.write([first], {
+                    'state': 'failed',
+                    'claim': None,
+                    'attempts': attempts,
+                    })
+            if rest:
+                cls.write(rest, {
+                        'state': 'blocked',
+                        'claim': None,
+                        })
+            return
+        delay = min(60 * 2 ** (attempts - 1), MAX_BACKOFF)
+        values = {
+            'state': 'pending',
+            'claim': None,
+            'next_attempt': (datetime.datetime.now()
+                + datetime.timedelta(seconds=delay)),
+            }
+        args = [[first], dict(values, attempts=attempts)]
+        if rest:
+            args.extend((rest, values))
+        cls.write(*args)
+
+    @classmethod
+    def get_metrics(cls):
+        "Return the queue depth and latency (in seconds)"
+        now = datetime.datetime.now()
+        pending = cls.search_count([
+                ('state', 'in', ['pending', 'processing']),
+                ])
+        oldest = cls.search([('state', 'in', ['pending', 'processing'])],
+            order=[('id', 'ASC')], limit=1)
+        failed = cls.search_count([('state', '=', 'failed')])
+        blocked = cls.search_count([('state', '=', 'blocked')])
+        last_done = cls.search([('state', '=', 'done')],
+            order=[('id', 'DESC')], limit=100)
+        latencies = [e.latency for e in last_done]
+        return {
+            'pending': pending,
+            'failed': failed,
+            'blocked': blocked,
+            'oldest_pending': ((now - oldest[0].create_date).total_seconds()
+                if oldest else 0),
+            'latency_avg': (sum(latencies) / len(latencies)
+                if latencies else 0),
+            'latency_max': max(latencies) if latencies else 0,
+            }
+
+    @classmethod
+    def log_metrics(cls):
+        logger = logging.getLogger('pyafipws')
+        logger.info(u'Cola CAE: %(pending)d pendientes, %(failed)d fallidas, '
+            u'%(blocked)d bloqueadas, mas antigua %(oldest_pending).0fs, '
+            u'demora promedio %(latency_avg).0fs (max %(latency_max).0fs)',
+            cls.get_metrics())
@@ -49,15 +49,14 @@ class Company(ModelSQL, ModelView):
 
     def pyafipws_authenticate(self, service="wsfe", force=False):
         "Authenticate against AFIP, returns token, sign, err_msg (dict)"
-        import afip_auth
+        from . import afip_auth
+        from . import afip_ws
         auth_data = {}
         # get the authentication credentials:
         certificate = str(self.pyafipws_certificate)
         private_key = str(self.pyafipws_private_key)
-        if self.pyafipws_mode_cert == 'homologacion':
-            WSAA_URL = "https://wsaahomo.afip.gov.ar/ws/services/LoginCms?wsdl"
-        elif self.pyafipws_mode_cert == 'produccion':
-            WSAA_URL = "https://wsaa.afip.gov.ar/ws/services/LoginCms?wsdl"
+        WSAA_URL = afip_ws.WSDL.get(('wsaa', self.pyafipws_mode_cert),
+            afip_auth.WSAA_URL)
 
         # call the helper function to obtain the access ticket:
         auth = afip_auth.authenticate(service, certificate, private_key, wsdl=WSAA_URL, force=force)
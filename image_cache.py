@@ -0,0 +1,58 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the Affero GNU General Public License as published by
+# the Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+"Cache of rendered images (QR codes, barcodes) for the invoice reports"
+
+__license__ = "AGPL 3.0"
+
+import collections
+import os
+import threading
+
+
+class ImageCache(object):
+    "Images kept in memory (bounded LRU) and, optionally, in a folder"
+
+    def __init__(self, size):
+        self.size = size
+        self._images = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, render, directory=None, extension="png"):
+        """Return the image of the key, calling render() only once.
+
+        key must be a valid file name (i.e. a hash), the files written in
+        the directory are shared by all the worker processes.
+        """
+        with self._lock:
+            image = self._images.pop(key, None)
+            if image is not None:
+                self._images[key] = image
+                return image
+        fn = directory and os.path.join(directory, "%s.%s" % (key, extension))
+        if fn and os.path.exists(fn):
+            with open(fn, "rb") as f:
+                image = f.read()
+        else:
+            image = render()
+            if fn:
+                from . import afip_auth
+                afip_auth.write_file(fn, image)
+        with self._lock:
+            self._images[key] = image
+            while len(self._images) > self.size:
+                self._images.popitem(last=False)
+        return image
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
@@ -4,17 +4,26 @@
 
 import collections
 import logging
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from decimal import Decimal
 import datetime
 
+from trytond import backend
 from trytond.model import ModelSQL, Workflow, fields, ModelView
 from trytond.report import Report
 from trytond.pyson import Eval, And, Equal
 from trytond.transaction import Transaction
 from trytond.pool import Pool, PoolMeta
-import base64
-import pyqrcode
-import io
+
+from . import afip_barcode
+from . import afip_qr
+from . import afip_ws
+from . import pdf_export
+from .report_labels import LabelIndex
 
 
 __all__ = ['Invoice', 'AfipWSTransaction', 'InvoiceReport', 'InvoiceCmpAsoc']
@@ -37,6 +46,22 @@ _POS_STATES.update({
 		'invisible': Eval('type').in_(['in_invoice', 'in_credit_note']),
 			})
 
+# WSFEv1 FECAESolicitar accepts up to 250 vouchers per request
+PYAFIPWS_BATCH_SIZE = 250
+# points of sale / invoice types authorized at the same time
+PYAFIPWS_MAX_WORKERS = 4
+# AFIP transactions inserted by each create call when the log is flushed
+PYAFIPWS_LOG_BATCH_SIZE = 100
+# XML payloads are truncated beyond this size (bytes) before compressing them
+PYAFIPWS_XML_MAX_SIZE = 512 * 1024
+# XML payloads of accepted transactions are discarded after these days
+PYAFIPWS_LOG_RETENTION_DAYS = 180
+
+# labels printed by the report, indexed on first use: database -> LabelIndex
+_LABEL_INDEX = {}
+# buffers of AFIP transactions waiting to be written (one stack per thread)
+_LOG_BUFFERS = threading.local()
+
 IVA_AFIP_CODE = collections.defaultdict(lambda: 0)
 IVA_AFIP_CODE.update({
 	Decimal('0'): 3,
@@ -231,12 +256,237 @@ class AfipWSTransaction(ModelSQL, ModelView):
 
 	pyafipws_message = fields.Text('Mensaje', readonly=True,
 	   help=u"Mensaje de error u observación, devuelto por AFIP")
-	pyafipws_xml_request = fields.Text('Requerimiento XML', readonly=True,
-	   help=u"Mensaje XML enviado a AFIP (depuración)")
-	pyafipws_xml_response = fields.Text('Respuesta XML', readonly=True,
-	   help=u"Mensaje XML recibido de AFIP (depuración)")
+	pyafipws_xml_request = fields.Function(fields.Text('Requerimiento XML',
+	   help=u"Mensaje XML enviado a AFIP (depuración)"), 'get_xml')
+	pyafipws_xml_response = fields.Function(fields.Text('Respuesta XML',
+	   help=u"Mensaje XML recibido de AFIP (depuración)"), 'get_xml')
+	# payloads are stored zlib compressed, read them through the fields above
+	pyafipws_xml_request_zlib = fields.Binary('Requerimiento XML (zlib)',
+		readonly=True)
+	pyafipws_xml_response_zlib = fields.Binary('Respuesta XML (zlib)',
+		readonly=True)
+	pyafipws_xml_request_size = fields.Integer('Tamaño requerimiento',
+		readonly=True, help=u"Tamaño (bytes) del mensaje XML sin comprimir")
+	pyafipws_xml_response_size = fields.Integer('Tamaño respuesta',
+		readonly=True, help=u"Tamaño (bytes) del mensaje XML sin comprimir")
+	archived = fields.Boolean('Archivada', readonly=True,
+		help=u"Los mensajes XML fueron descartados por antigüedad")
+
+	invoice = fields.Many2One('account.invoice', 'Invoice', select=True)
+	# the CAE granted, stored on the invoice by the next post if it failed
+	pyafipws_cbte_nro = fields.Integer(u'Número', readonly=True,
+		help=u"Número de comprobante informado a la AFIP")
+	pyafipws_cae = fields.Char('CAE', size=14, readonly=True)
+	pyafipws_cae_due_date = fields.Date('Vencimiento CAE', readonly=True)
+	pyafipws_barcode = fields.Char(u'Codigo de Barras', size=40,
+		readonly=True)
+	batch = fields.Many2One('account_invoice_ar.afip_transaction', 'Lote',
+		readonly=True, ondelete='SET NULL',
+		help=u"Transacción que guarda los mensajes XML del lote")
+
+	@classmethod
+	def __setup__(cls):
+		super(AfipWSTransaction, cls).__setup__()
+		cls._order.insert(0, ('create_date', 'DESC'))
+
+	@classmethod
+	def __register__(cls, module_name):
+		TableHandler = backend.get('TableHandler')
+		cursor = Transaction().cursor
+		if TableHandler.table_exist(cursor, cls._table):
+			table = TableHandler(cursor, cls, module_name)
+			# migration: the xml payloads were stored in plain text columns
+			for name in ('pyafipws_xml_request', 'pyafipws_xml_response'):
+				if (table.column_exist(name)
+						and not table.column_exist(name + '_text')):
+					table.column_rename(name, name + '_text')
+		super(AfipWSTransaction, cls).__register__(module_name)
+
+		table = TableHandler(cursor, cls, module_name)
+		if table.column_exist('pyafipws_xml_request_text'):
+			cls._migrate_xml_text()
+			table.drop_column('pyafipws_xml_request_text')
+			table.drop_column('pyafipws_xml_response_text')
+
+	@classmethod
+	def _migrate_xml_text(cls):
+		"Compress the payloads stored as plain text (in batches)"
+		cursor = Transaction().cursor
+		sql_table = cls.__table__()
+		request = sql_table.pyafipws_xml_request_text
+		response = sql_table.pyafipws_xml_response_text
+		cursor.execute(*sql_table.select(sql_table.id,
+				where=(request != None) | (response != None)))
+		ids = [row[0] for row in cursor.fetchall()]
+		for i in xrange(0, len(ids), PYAFIPWS_LOG_BATCH_SIZE):
+			sub_ids = ids[i:i + PYAFIPWS_LOG_BATCH_SIZE]
+			cursor.execute(*sql_table.select(sql_table.id, request, response,
+					where=sql_table.id.in_(sub_ids)))
+			for id_, xml_request, xml_response in cursor.fetchall():
+				request_zlib, request_size = compress_xml(xml_request)
+				response_zlib, response_size = compress_xml(xml_response)
+				cursor.execute(*sql_table.update(
+						[sql_table.pyafipws_xml_request_zlib,
+							sql_table.pyafipws_xml_request_size,
+							sql_table.pyafipws_xml_response_zlib,
+							sql_table.pyafipws_xml_response_size],
+						[request_zlib, request_size,
+							response_zlib, response_size],
+						where=sql_table.id == id_))
+
+	@staticmethod
+	def default_archived():
+		return False
+
+	@classmethod
+	def get_xml(cls, transactions, names):
+		result = {}
+		for name in names:
+			result[name] = values = {}
+			for transaction in transactions:
+				payload = getattr(transaction, name + '_zlib')
+				if payload is None and transaction.batch:
+					# the payload of the request is stored once for the batch
+					payload = getattr(transaction.batch, name + '_zlib')
+				values[transaction.id] = decompress_xml(payload)
+		return result
+
+	@classmethod
+	@contextmanager
+	def buffered(cls):
+		'''
+		Keep the transactions logged inside the block in memory and write
+		them all at the end, in a new cursor (so they are kept even if the
+		current transaction is rolled back). Nested blocks share the buffer.
+		'''
+		stack = _LOG_BUFFERS.__dict__.setdefault('stack', [])
+		if stack:
+			yield
+			return
+		entries = []
+		stack.append(entries)
+		try:
+			yield
+		finally:
+			stack.pop()
+			cls.flush(entries)
+
+	@classmethod
+	def log(cls, invoice, result, message, xml_request, xml_response,
+			last_cbte=None, batch=None, cae_values=None, checked=False):
+		'''
+		Log an AFIP webservice call of the invoice, and the last voucher
+		number known for its invoice type (None to check it with AFIP,
+		checked if it was just queried).
+		The payloads of the invoices of the same batch (request) are stored
+		once, the other transactions link to it. The cae_values (CAE, due
+		date, barcode and number) granted are kept with the transaction.
+		Written at the end of the buffered block, or right away outside one.
+		'''
+		values = {
+			'pyafipws_result': result,
+			'pyafipws_message': message,
+			'pyafipws_xml_request': xml_request,
+			'pyafipws_xml_response': xml_response,
+			}
+		values.update(cae_values or {})
+		entry = (invoice, values, last_cbte, batch, checked)
+		stack = getattr(_LOG_BUFFERS, 'stack', None)
+		if stack:
+			stack[-1].append(entry)
+		else:
+			cls.flush([entry])
+
+	@classmethod
+	def flush(cls, entries):
+		"Write the logged transactions and voucher numbers at once"
+		if not entries:
+			return
+		vlist = []
+		last_cbte = collections.OrderedDict()
+		# index of the entry that stores the payload of each batch
+		owners = {}
+		members = collections.OrderedDict()
+		for i, (invoice, values, number, batch, checked) in enumerate(
+				entries):
+			if batch is not None:
+				if batch in owners:
+					members.setdefault(owners[batch], []).append(i)
+					values = dict(values, pyafipws_xml_request=None,
+						pyafipws_xml_response=None)
+				else:
+					owners[batch] = i
+			vlist.append(cls._get_log_values(invoice, values))
+			checked = checked or last_cbte.get(invoice.invoice_type,
+				(None, False))[1]
+			last_cbte[invoice.invoice_type] = (number, checked)
+		with Transaction().new_cursor():
+			transactions = []
+			for i in xrange(0, len(vlist), PYAFIPWS_LOG_BATCH_SIZE):
+				transactions.extend(
+					cls.create(vlist[i:i + PYAFIPWS_LOG_BATCH_SIZE]))
+			args = []
+			for owner, indexes in members.iteritems():
+				args.extend(([transactions[i] for i in indexes], {
+							'batch': transactions[owner].id,
+							}))
+			if args:
+				cls.write(*args)
+			# keep the numbering known, or check it with AFIP next time
+			for invoice_type, (number, checked) in last_cbte.iteritems():
+				invoice_type.set_pyafipws_last_cbte(number, checked=checked)
+			Transaction().cursor.commit()
 
-	invoice = fields.Many2One('account.invoice', 'Invoice')
+	@staticmethod
+	def _get_log_values(invoice, values):
+		values = values.copy()
+		values['invoice'] = invoice.id
+		for name in ('pyafipws_xml_request', 'pyafipws_xml_response'):
+			values[name + '_zlib'], values[name + '_size'] = compress_xml(
+				values.pop(name))
+		return values
+
+	@classmethod
+	def archive(cls):
+		'''
+		Discard the XML payloads of the accepted transactions older than
+		the retention period (cron), the summary of the transaction is kept.
+		'''
+		limit = (datetime.datetime.now()
+			- datetime.timedelta(days=PYAFIPWS_LOG_RETENTION_DAYS))
+		while True:
+			transactions = cls.search([
+					('pyafipws_result', '=', 'A'),
+					('archived', '=', False),
+					('create_date', '<', limit),
+					], limit=PYAFIPWS_LOG_BATCH_SIZE * 10)
+			if not transactions:
+				break
+			cls.write(transactions, {
+					'pyafipws_xml_request_zlib': None,
+					'pyafipws_xml_response_zlib': None,
+					'archived': True,
+					})
+			Transaction().cursor.commit()
+
+
+def compress_xml(xml):
+	"Return the xml (capped to PYAFIPWS_XML_MAX_SIZE) compressed and its size"
+	if not xml:
+		return None, 0
+	if isinstance(xml, unicode):
+		xml = xml.encode('utf-8')
+	size = len(xml)
+	if size > PYAFIPWS_XML_MAX_SIZE:
+		xml = xml[:PYAFIPWS_XML_MAX_SIZE] + '\n<!-- truncado: %d bytes -->' % (
+			size - PYAFIPWS_XML_MAX_SIZE)
+	return buffer(zlib.compress(xml)), size
+
+
+def decompress_xml(data):
+	if not data:
+		return None
+	return zlib.decompress(str(data)).decode('utf-8', 'replace')
 
 
 class Invoice:
@@ -295,10 +545,10 @@ class Invoice:
 		'Incoterms',
 	)
 
-	qr_imagen = fields.Binary(u'Código QR',
+	qr_imagen = fields.Function(fields.Binary(u'Código QR',
 									states={
 										'invisible': True,
-									})
+									}), 'get_qr_imagen')
 	qr_codigo = fields.Char(u'Información Código QR',
 								states={
 									'invisible': True,
@@ -372,6 +622,16 @@ class Invoice:
 				u'Debe establecer el valor de Incoterms si desea realizar un tipo de "Factura E".',
 			})
 
+	@classmethod
+	def __register__(cls, module_name):
+		TableHandler = backend.get('TableHandler')
+		cursor = Transaction().cursor
+		super(Invoice, cls).__register__(module_name)
+		table = TableHandler(cursor, cls, module_name)
+		# migration: the QR image was stored, it is rendered from qr_texto_modificado
+		if table.column_exist('qr_imagen'):
+			table.drop_column('qr_imagen')
+
 	@classmethod
 	@ModelView.button
 	@Workflow.transition('validated')
@@ -435,20 +695,20 @@ class Invoice:
 		invoice_type, invoice_type_desc = INVOICE_TYPE_AFIP_CODE[
 			(self.type, kind)
 			]
-		sequences = PosSequence.search([
-			('pos', '=', self.pos.id),
-			('invoice_type', '=', invoice_type)
-			])
+		sequences = PosSequence.get_sequences(self.pos.id, invoice_type)
 		if len(sequences) == 0:
 			self.raise_user_error('missing_sequence', invoice_type_desc)
 		elif len(sequences) > 1:
 			self.raise_user_error('too_many_sequences', invoice_type_desc)
 		else:
-			res['invoice_type'] = sequences[0].id
+			res['invoice_type'] = sequences[0]
 
 		return res
 
 	def set_number(self):
+		if self.number and self.pyafipws_cae:
+			# numbered by pyafipws_reconcile (CAE granted in a failed post)
+			return
 		super(Invoice, self).set_number()
 
 		if self.type == 'out_invoice' or self.type == 'out_credit_note':
@@ -476,116 +736,388 @@ class Invoice:
 	@ModelView.button
 	@Workflow.transition('posted')
 	def post(cls, invoices):
-		Move = Pool().get('account.move')
+		pool = Pool()
+		Move = pool.get('account.move')
+		CaeQueue = pool.get('account_invoice_ar.cae_queue')
 
-		moves = []
+		electronic = []
+		electronic_ids = set()
+		queued = []
 		for invoice in invoices:
 			if invoice.type == u'out_invoice' or invoice.type == u'out_credit_note':
 				if not invoice.invoice_type:
 					invoice.raise_user_error('not_invoice_type')
-				if invoice.pos:
-					if invoice.pos.pos_type == 'electronic':
-						invoice.do_pyafipws_request_cae()
-						if not invoice.pyafipws_cae:
-							invoice.raise_user_error('not_cae')
+				if invoice.pos and invoice.pos.pos_type == 'electronic':
+					if invoice.pos.pyafipws_cae_mode == 'queued':
+						# the CAE is requested later by the queue worker
+						queued.append(invoice)
+					else:
+						electronic.append(invoice)
+						electronic_ids.add(invoice.id)
+		cls.do_pyafipws_request_cae_batch(electronic)
+
+		moves = []
+		for invoice in invoices:
+			if invoice.id in electronic_ids and not invoice.pyafipws_cae:
+				invoice.raise_user_error('not_cae')
 			invoice.set_number()
-			if invoice.type == u'out_invoice' or invoice.type == u'out_credit_note':
-				if invoice.pos.pos_type == 'electronic':
-					invoice.crear_codigo_qr()
+			if invoice.id in electronic_ids:
+				invoice.crear_codigo_qr()
 			moves.append(invoice.create_move())
 		cls.write(invoices, {
 				'state': 'posted',
 				})
 		Move.post(moves)
+		CaeQueue.enqueue(queued)
 		#Bug: https://github.com/tryton-ar/account_invoice_ar/issues/38
 		#for invoice in invoices:
 		#    if invoice.type in ('out_invoice', 'out_credit_note'):
 		#        invoice.print_invoice()
 
-	def do_pyafipws_request_cae(self):
-		logger = logging.getLogger('pyafipws')
-		"Request to AFIP the invoices' Authorization Electronic Code (CAE)"
-		# if already authorized (electronic invoice with CAE), ignore
-		if self.pyafipws_cae:
-			logger.info(u'Se trata de obtener CAE de la factura que ya tiene. '\
-						u'Factura: %s, CAE: %s', self.number, self.pyafipws_cae)
+	@classmethod
+	def do_pyafipws_request_cae_batch(cls, invoices):
+		'''
+		Request the CAE of several invoices, grouped in WSFEv1 batches.
+		Each point of sale and invoice type is an independent stream of
+		numbers, the streams are sent to AFIP concurrently.
+		The AFIP transactions are logged all together at the end.
+		'''
+		AFIP_Transaction = Pool().get('account_invoice_ar.afip_transaction')
+		with AFIP_Transaction.buffered():
+			cls._pyafipws_request_cae_batch(invoices)
+
+	@classmethod
+	def _pyafipws_request_cae_batch(cls, invoices):
+		cls.pyafipws_reconcile(invoices)
+		streams = collections.OrderedDict()
+		for invoice in invoices:
+			if invoice.pyafipws_cae:
+				continue
+			if invoice.pos.pyafipws_electronic_invoice_service != 'wsfe':
+				# only WSFEv1 accepts many vouchers per request
+				invoice.do_pyafipws_request_cae()
+				continue
+			key = (invoice.pos.number, invoice.invoice_type.invoice_type)
+			streams.setdefault(key, []).append(invoice)
+		if not streams:
 			return
-		# get the electronic invoice type, point of sale and service:
-		pool = Pool()
 
-		Company = pool.get('company.company')
-		company_id = Transaction().context.get('company')
-		if not company_id:
-			logger.info(u'No hay companía')
+		first = streams.values()[0][0]
+		company = first._pyafipws_get_company()
+		if not company:
 			return
+		service = 'wsfe'
+		auth_data = company.pyafipws_authenticate(service=service)
+		client_key = (company.id, service, company.pyafipws_mode_cert)
 
-		company = Company(company_id)
+		# the database is only used from this thread: prepare the requests,
+		# send them in a pool of threads and then store the results
+		jobs = []
+		try:
+			for key, stream in streams.iteritems():
+				ws = afip_ws.acquire(*client_key + (company.party.vat_number,
+						auth_data['token'], auth_data['sign']))
+				jobs.append({'key': key, 'ws': ws, 'invoices': stream})
+				if not hasattr(ws, 'CAESolicitarX'):
+					break
+				cls._pyafipws_prepare_stream(jobs[-1])
+			else:
+				if len(jobs) > 1:
+					threads = ThreadPool(min(len(jobs), PYAFIPWS_MAX_WORKERS))
+					try:
+						threads.map(cls._pyafipws_send_stream, jobs)
+					finally:
+						threads.close()
+						threads.join()
+				else:
+					cls._pyafipws_send_stream(jobs[0])
+		finally:
+			for job in jobs:
+				afip_ws.release(*client_key + (job['ws'],))
+
+		if jobs and not hasattr(jobs[0]['ws'], 'CAESolicitarX'):
+			# pyafipws without batch support, one request per invoice
+			for stream in streams.itervalues():
+				for invoice in stream:
+					invoice.do_pyafipws_request_cae()
+			return
 
-		tipo_cbte = self.invoice_type.invoice_type
-		punto_vta = self.pos.number
-		service = self.pos.pyafipws_electronic_invoice_service
-		# check if it is an electronic invoice sale point:
-		##TODO
-		#if not tipo_cbte:
-		#    self.raise_user_error('invalid_sequence', pos.invoice_type.invoice_type)
+		if all(cls._pyafipws_stream_authorized(job) for job in jobs):
+			for job in jobs:
+				cls._pyafipws_store_stream(job)
+			return
+		# the post fails, but AFIP already used the numbers of the CAEs
+		# granted: they are only logged (the log survives the rollback) and
+		# stored on the invoices by the next post, see pyafipws_reconcile
+		for job in jobs:
+			cls._pyafipws_store_stream(job, store=False)
+		for job in jobs:
+			first = job['invoices'][0]
+			if job['error']:
+				raise job['error']
+			if job['cbte_nro_afip'] + 1 != job['cbte_nro']:
+				first.raise_user_error('invalid_invoice_number',
+					(job['cbte_nro'], job['cbte_nro_afip'] + 1))
+			for invoice, result in zip(job['invoices'], job['results']):
+				if not result.CAE:
+					invoice.raise_user_error('not_cae')
+			if len(job['results']) < len(job['invoices']):
+				job['invoices'][len(job['results'])].raise_user_error(
+					'not_cae')
+
+	@staticmethod
+	def _pyafipws_stream_authorized(job):
+		"Return if AFIP granted the CAE of all the invoices of the stream"
+		return (not job['error']
+			and job['cbte_nro_afip'] is not None
+			and job['cbte_nro_afip'] + 1 == job['cbte_nro']
+			and len(job['results']) == len(job['invoices'])
+			and all(r.CAE for r in job['results']))
 
-		# authenticate against AFIP:
-		auth_data = company.pyafipws_authenticate(service=service)
+	@classmethod
+	def _pyafipws_prepare_stream(cls, job):
+		"Create the invoices of a stream in the helper, in batches"
+		service = 'wsfe'
+		ws = job['ws']
+		invoices = job['invoices']
+		first = invoices[0]
+		cbte_nro = first._pyafipws_get_cbte_nro()
+		# trust the last number stored locally if it matches the sequence
+		cbte_nro_last = first.invoice_type.get_pyafipws_last_cbte()
+		if cbte_nro_last is not None and cbte_nro_last + 1 == cbte_nro:
+			job['cbte_nro_afip'] = cbte_nro_last
+		else:
+			job['cbte_nro_afip'] = None
+
+		# consecutive numbers, the sequence assigns them in the same order
+		job['chunks'] = []
+		for i, invoice in enumerate(invoices):
+			if (invoice.state == 'posted'
+					and invoice._pyafipws_get_cbte_nro() != cbte_nro + i):
+				# queued invoices already have their number
+				invoice.raise_user_error('invalid_invoice_number',
+					(invoice._pyafipws_get_cbte_nro(), cbte_nro + i))
+			if not i % PYAFIPWS_BATCH_SIZE:
+				ws.facturas = []
+				job['chunks'].append(ws.facturas)
+			invoice._pyafipws_create_invoice(ws, service, cbte_nro + i)
+			ws.AgregarFacturaX()
+		job['cbte_nro'] = cbte_nro
+		job['checked'] = job['cbte_nro_afip'] is None
+		job['results'] = []
+		job['error'] = None
+
+	@staticmethod
+	def _pyafipws_send_stream(job):
+		'''
+		Send the batches of a stream to AFIP, it runs in its own thread and
+		must not use the database.
+		'''
+		ws = job['ws']
+		first = job['invoices'][0]
+		try:
+			if job['checked']:
+				# get the last invoice number registered in AFIP
+				tipo_cbte = job['key'][1]
+				punto_vta = job['key'][0]
+				job['cbte_nro_afip'] = int(
+					ws.CompUltimoAutorizado(tipo_cbte, punto_vta) or 0)
+			if job['cbte_nro_afip'] + 1 != job['cbte_nro']:
+				return
+			for facturas in job['chunks']:
+				ws.facturas = facturas
+				# the same request and response for all the vouchers
+				batch = object()
+				try:
+					ws.CAESolicitarX()
+				except Exception, e:
+					msg = first._pyafipws_exception_message(ws, e)
+					job['results'].extend(afip_ws.Result(ws, msg, batch)
+						for factura in facturas)
+					return
+				for i in range(len(facturas)):
+					# load the result of the i-th voucher (CAE, Vencimiento...)
+					ws.LeerFacturaX(i)
+					job['results'].append(afip_ws.Result(ws, batch=batch))
+				if not all(r.CAE for r in job['results']):
+					# the next vouchers would be rejected, keep the numbering
+					return
+		except Exception, e:
+			job['error'] = e
 
-		# import the AFIP webservice helper for electronic invoice
-		if service == 'wsfe':
-			from pyafipws.wsfev1 import WSFEv1  # local market
-			ws = WSFEv1()
-			if company.pyafipws_mode_cert == 'homologacion':
-				WSDL = "https://wswhomo.afip.gov.ar/wsfev1/service.asmx?WSDL"
-			elif company.pyafipws_mode_cert == 'produccion':
-				WSDL = "https://servicios1.afip.gov.ar/wsfev1/service.asmx?WSDL"
-		#elif service == 'wsmtxca':
+	@classmethod
+	def _pyafipws_store_stream(cls, job, store=True):
+		'''
+		Store the results of a stream on its invoices and transactions.
+		Without store, the results are only logged.
+		'''
+		service = 'wsfe'
+		for i, (invoice, result) in enumerate(
+				zip(job['invoices'], job['results'])):
+			invoice._pyafipws_store_result(result, service, result.msg,
+				result.Vencimiento, job['cbte_nro'] + i,
+				checked=job['checked'] and i == 0, store=store)
+
+	@classmethod
+	def pyafipws_reconcile(cls, invoices):
+		'''
+		Store on the invoices without CAE the CAEs granted to them by a
+		failed post (or queue run), found in the AFIP transactions log with
+		the number the invoice gets, and number them.
+		Returns the invoices reconciled.
+		'''
+		AFIP_Transaction = Pool().get('account_invoice_ar.afip_transaction')
+		pending = [i for i in invoices if not i.pyafipws_cae
+			and i.pos and i.pos.pos_type == 'electronic']
+		if not pending:
+			return []
+		granted = {}
+		for transaction in AFIP_Transaction.search([
+					('invoice', 'in', [i.id for i in pending]),
+					('pyafipws_cae', '!=', None),
+					]):
+			granted[(transaction.invoice.id,
+					transaction.pyafipws_cbte_nro)] = transaction
+		reconciled = []
+		for invoice in pending:
+			# in number order, each one numbered moves the sequence on
+			transaction = granted.get((invoice.id,
+					invoice._pyafipws_get_cbte_nro()))
+			if transaction is None:
+				continue
+			cls.write([invoice], {
+					'pyafipws_cae': transaction.pyafipws_cae,
+					'pyafipws_cae_due_date': transaction.pyafipws_cae_due_date,
+					'pyafipws_barcode': transaction.pyafipws_barcode,
+					})
+			invoice.set_number()
+			reconciled.append(invoice)
+		return reconciled
+
+	def _pyafipws_get_company(self):
+		logger = logging.getLogger('pyafipws')
+		Company = Pool().get('company.company')
+		company_id = Transaction().context.get('company')
+		if not company_id:
+			logger.info(u'No hay companía')
+			return None
+		return Company(company_id)
+
+	@contextmanager
+	def _pyafipws_client(self, company, service):
+		"Yield the AFIP webservice helper connected and authenticated"
+		logger = logging.getLogger('pyafipws')
+
+		#if service == 'wsmtxca':
 		#    from pyafipws.wsmtx import WSMTXCA, SoapFault   # local + detail
 		#    ws = WSMTXCA()
-		elif service == 'wsfex':
-			from pyafipws.wsfexv1 import WSFEXv1 # foreign trade
-			ws = WSFEXv1()
-			if company.pyafipws_mode_cert == 'homologacion':
-				WSDL = "https://wswhomo.afip.gov.ar/wsfexv1/service.asmx?WSDL"
-			elif company.pyafipws_mode_cert == 'produccion':
-				WSDL = "https://servicios1.afip.gov.ar/wsfexv1/service.asmx?WSDL"
-		else:
+		if service not in afip_ws.SERVICES:
 			logger.critical(u'WS no soportado: %s', service)
+			yield None
 			return
 
-		# connect to the webservice and call to the test method
-		ws.LanzarExcepciones = True
-		ws.Conectar(wsdl=WSDL)
-		# set AFIP webservice credentials:
-		ws.Cuit = company.party.vat_number
-		ws.Token = auth_data['token']
-		ws.Sign = auth_data['sign']
-
+		# authenticate against AFIP:
+		auth_data = company.pyafipws_authenticate(service=service)
 
-		# get the last 8 digit of the invoice number
+		# reuse a connected client of the pool (or connect a new one)
+		with afip_ws.checkout(company.id, service,
+				company.pyafipws_mode_cert, company.party.vat_number,
+				auth_data['token'], auth_data['sign']) as ws:
+			yield ws
+
+	def _pyafipws_get_cbte_nro(self):
+		"Return the number the invoice sequence will assign (8 digits)"
+		if self.state == 'posted' and self.number:
+			# posted without CAE (queued), the number is already assigned
+			return int(self.number[-8:])
 		if self.move:
-			cbte_nro = int(self.move.number[-8:])
-		else:
-			Sequence = pool.get('ir.sequence')
-			cbte_nro = int(Sequence(
-				self.invoice_type.invoice_sequence.id).get_number_next(''))
+			return int(self.move.number[-8:])
+		Sequence = Pool().get('ir.sequence')
+		return int(Sequence(
+			self.invoice_type.invoice_sequence.id).get_number_next(''))
+
+	def _pyafipws_get_cbte_nro_next(self, ws, service, cbte_nro=None):
+		"Return the next invoice number expected by AFIP"
+		# trust the last number stored locally if it matches the sequence
+		cbte_nro_last = self.invoice_type.get_pyafipws_last_cbte()
+		if cbte_nro_last is not None and cbte_nro_last + 1 == cbte_nro:
+			return cbte_nro
 
+		tipo_cbte = self.invoice_type.invoice_type
+		punto_vta = self.pos.number
 		# get the last invoice number registered in AFIP
 		if service == "wsfe" or service == "wsmtxca":
 			cbte_nro_afip = ws.CompUltimoAutorizado(tipo_cbte, punto_vta)
-			
 		elif service == 'wsfex':
 			cbte_nro_afip = ws.GetLastCMP(tipo_cbte, punto_vta)
-		cbte_nro_next = int(cbte_nro_afip or 0) + 1
+		with Transaction().new_cursor():
+			self.invoice_type.set_pyafipws_last_cbte(int(cbte_nro_afip or 0),
+				checked=True)
+			Transaction().cursor.commit()
+		return int(cbte_nro_afip or 0) + 1
+
+	def do_pyafipws_request_cae(self):
+		logger = logging.getLogger('pyafipws')
+		"Request to AFIP the invoices' Authorization Electronic Code (CAE)"
+		# if already authorized (electronic invoice with CAE), ignore
+		if self.pyafipws_cae:
+			logger.info(u'Se trata de obtener CAE de la factura que ya tiene. '\
+						u'Factura: %s, CAE: %s', self.number, self.pyafipws_cae)
+			return
+		# get the electronic invoice type, point of sale and service:
+		company = self._pyafipws_get_company()
+		if not company:
+			return
+
+		service = self.pos.pyafipws_electronic_invoice_service
+		# check if it is an electronic invoice sale point:
+		##TODO
+		#if not tipo_cbte:
+		#    self.raise_user_error('invalid_sequence', pos.invoice_type.invoice_type)
+
+		with self._pyafipws_client(company, service) as ws:
+			if ws is not None:
+				self._pyafipws_request_cae(ws, service)
+
+	def _pyafipws_request_cae(self, ws, service):
+		"Request the CAE of the invoice with a connected helper"
+		# get the last 8 digit of the invoice number
+		cbte_nro = self._pyafipws_get_cbte_nro()
+		cbte_nro_next = self._pyafipws_get_cbte_nro_next(ws, service, cbte_nro)
 		# verify that the invoice is the next one to be registered in AFIP
-		
 		if cbte_nro != cbte_nro_next:
 			self.raise_user_error('invalid_invoice_number', (cbte_nro, cbte_nro_next))
 
-		
+		self._pyafipws_create_invoice(ws, service, cbte_nro_next)
+
+		# Request the authorization! (call the AFIP webservice method)
+		vto = None
+		try:
+			if service == 'wsfe':
+				ws.CAESolicitar()
+				vto = ws.Vencimiento
+			elif service == 'wsmtxca':
+				ws.AutorizarComprobante()
+				vto = ws.Vencimiento
+			elif service == 'wsfex':
+				ws.Authorize(self.id)
+				vto = ws.FchVencCAE
+		#except SoapFault as fault:
+		#    msg = 'Falla SOAP %s: %s' % (fault.faultcode, fault.faultstring)
+		except Exception, e:
+			msg = self._pyafipws_exception_message(ws, e)
+		else:
+			msg = u"\n".join([ws.Obs or "", ws.ErrMsg or ""])
+		self._pyafipws_store_result(ws, service, msg, vto, cbte_nro_next)
+
+	def _pyafipws_create_invoice(self, ws, service, cbte_nro):
+		"Create the invoice internally in the AFIP webservice helper"
+		pool = Pool()
+		tipo_cbte = self.invoice_type.invoice_type
+		punto_vta = self.pos.number
+
 		# invoice number range (from - to) and date:
-		cbte_nro = cbt_desde = cbt_hasta = cbte_nro_next
+		cbt_desde = cbt_hasta = cbte_nro
 
 		if self.invoice_date:
 			fecha_cbte = self.invoice_date.strftime("%Y-%m-%d")
@@ -837,32 +1369,27 @@ class Invoice:
 					ws.AgregarItem(codigo, ds, qty, umed, precio, importe_total,
 								   bonif)
 
-		# Request the authorization! (call the AFIP webservice method)
-		try:
-			if service == 'wsfe':
-				ws.CAESolicitar()
-				vto = ws.Vencimiento
-			elif service == 'wsmtxca':
-				ws.AutorizarComprobante()
-				vto = ws.Vencimiento
-			elif service == 'wsfex':
-				ws.Authorize(self.id)
-				vto = ws.FchVencCAE
-		#except SoapFault as fault:
-		#    msg = 'Falla SOAP %s: %s' % (fault.faultcode, fault.faultstring)
-		except Exception, e:
-			if ws.Excepcion:
-				# get the exception already parsed by the helper
-				#import ipdb; ipdb.set_trace()  # XXX BREAKPOINT
-				msg = ws.Excepcion + ' ' + str(e)
-			else:
-				# avoid encoding problem when reporting exceptions to the user:
-				import traceback
-				import sys
-				msg = traceback.format_exception_only(sys.exc_type,
-													  sys.exc_value)[0]
-		else:
-			msg = u"\n".join([ws.Obs or "", ws.ErrMsg or ""])
+	def _pyafipws_exception_message(self, ws, e):
+		"Return the error message of a failed AFIP webservice call"
+		if ws.Excepcion:
+			# get the exception already parsed by the helper
+			return ws.Excepcion + ' ' + str(e)
+		# avoid encoding problem when reporting exceptions to the user:
+		import traceback
+		import sys
+		return traceback.format_exception_only(sys.exc_type,
+											  sys.exc_value)[0]
+
+	def _pyafipws_store_result(self, ws, service, msg, vto, cbte_nro,
+			checked=False, store=True):
+		'''
+		Log the AFIP transaction and store the CAE returned (if any),
+		without store it is only logged
+		'''
+		pool = Pool()
+		tipo_cbte = self.invoice_type.invoice_type
+		punto_vta = self.pos.number
+
 		# calculate the barcode:
 		if ws.CAE:
 			cae_due = ''.join([c for c in str(ws.Vencimiento or '')
@@ -874,19 +1401,8 @@ class Invoice:
 		else:
 			bars = ""
 
-		AFIP_Transaction = pool.get('account_invoice_ar.afip_transaction')
-		with Transaction().new_cursor():
-			AFIP_Transaction.create([{'invoice': self,
-								'pyafipws_result': ws.Resultado,
-								'pyafipws_message': msg,
-								'pyafipws_xml_request': ws.XmlRequest,
-								'pyafipws_xml_response': ws.XmlResponse,
-								}])
-			Transaction().cursor.commit()
-
+		vals = {}
 		if ws.CAE:
-
-			# store the results
 			vals = {'pyafipws_cae': ws.CAE,
 				   'pyafipws_cae_due_date': vto or None,
 				   'pyafipws_barcode': bars,
@@ -895,6 +1411,15 @@ class Invoice:
 				fe = vals['pyafipws_cae_due_date']
 				vals['pyafipws_cae_due_date'] = '-'.join([fe[:4],fe[4:6],fe[6:8]])
 
+		AFIP_Transaction = pool.get('account_invoice_ar.afip_transaction')
+		AFIP_Transaction.log(self, ws.Resultado, msg, ws.XmlRequest,
+			ws.XmlResponse, last_cbte=cbte_nro if ws.CAE else None,
+			batch=getattr(ws, 'batch', None),
+			cae_values=dict(vals, pyafipws_cbte_nro=cbte_nro) if vals else None,
+			checked=checked)
+
+		if vals and store:
+			# store the results
 			self.write([self], vals)
 
 
@@ -920,6 +1445,12 @@ class Invoice:
 	
 
 
+	def get_qr_imagen(self, name):
+		if not self.qr_texto_modificado:
+			return None
+		# smallest QR version that fits the payload
+		return buffer(afip_qr.get_image(self.qr_texto_modificado))
+
 	def crear_codigo_qr(self):
 		######################################################################################################################
 		#
@@ -927,7 +1458,20 @@ class Invoice:
 		#
 		######################################################################################################################
 		# si el POS es tipo electronico genero el codigo QR
+		dict_invoice = self.get_qr_data()
+		if dict_invoice:
+			vals = {}
+			vals['qr_codigo'], vals['qr_texto_modificado'] = afip_qr.encode(
+				dict_invoice)
+
+			# the image is rendered when read (see get_qr_imagen)
+			self.write([self], vals)
+		return True
+
+	def get_qr_data(self):
+		"Return the fields of the QR code payload (None if not electronic)"
 		if self.pos.pos_type == 'electronic':
+			nro_doc, tipo_doc = '0', 99  # NO DEFINIDO
 			if self.party.iva_condition == 'consumidor_final':
 				nro_doc = self.party.vat_number
 				if len(str(nro_doc).strip()) > 5:
@@ -963,9 +1507,8 @@ class Invoice:
 						tipo_doc = 96  # DNI
 					else:
 						tipo_doc = 99  # NO DEFINIDO
-			
-			vals = {}
-			dict_invoice = {
+
+			return {
 				'ver': 1,
 				'fecha': str(self.invoice_date),
 				'cuit': int(self.company.party.vat_number),
@@ -978,29 +1521,8 @@ class Invoice:
 				'tipoDocRec': int(tipo_doc),
 				'nroDocRec': int(nro_doc),
 				'tipoCodAut': 'E',
-				'codAut': self.pyafipws_cae,
+				'codAut': int(self.pyafipws_cae),
 			}
-			res = str(dict_invoice).replace("\n", "")
-			vals['qr_codigo'] = res
-
-			if type(dict_invoice) == dict:
-				enc = res.encode()
-				b64 = base64.encodestring(enc)
-				string_qr = 'https://www.afip.gob.ar/fe/qr/?p=' + str(b64)
-			else:
-				string_qr = 'https://www.afip.gob.ar/fe/qr/?ERROR'
-			vals['qr_texto_modificado'] = string_qr		
-		
-			url = pyqrcode.create(string_qr, error='L', version=13, mode='binary')
-			with open('/opt/tryton/tryton/code.png', 'w') as fstream:
-				url.png(fstream, scale=1)
-				buffer = io.BytesIO()
-				url.png(buffer)
-				vals['qr_imagen'] = buffer.getvalue()
-		
-		
-			self.write([self], vals)
-		return True
 
 
 	@classmethod
@@ -1019,17 +1541,14 @@ class Invoice:
 
 			# Agrego Invoice Type de NC facturas comunes
 			if invoice.invoice_type.invoice_type == '1':  # Factura A
-				account_pos_sequence = AccountPosSequence.search([
-				('invoice_type', '=', '3'),
-				('pos', '=', invoice.invoice_type.pos),
-				])
+				account_pos_sequence = AccountPosSequence.get_sequences(
+					invoice.invoice_type.pos.id, '3')
 			elif invoice.invoice_type.invoice_type == '6':
-				account_pos_sequence = AccountPosSequence.search([
-				('invoice_type', '=', '8'),
-				('pos', '=', invoice.invoice_type.pos),
-				])
+				account_pos_sequence = AccountPosSequence.get_sequences(
+					invoice.invoice_type.pos.id, '8')
 
-			new_invoice.invoice_type = account_pos_sequence[0]
+			new_invoice.invoice_type = AccountPosSequence(
+				account_pos_sequence[0])
 			new_invoice.invoice_date = datetime.date.today()
 			new_invoice.pyafipws_concept = invoice.pyafipws_concept
 			new_invoice.pyafipws_billing_start_date = invoice.pyafipws_billing_start_date
@@ -1082,61 +1601,132 @@ class Invoice:
 class InvoiceReport(Report):
 	__name__ = 'account.invoice'
 
+	@classmethod
+	def _get_label_index(cls):
+		'''
+		Return the labels index of the database, built on first use (once
+		the modules extending the selections are set up)
+		'''
+		database = Transaction().cursor.database_name
+		index = _LABEL_INDEX.get(database)
+		if index is None:
+			pool = Pool()
+			PosSequence = pool.get('account.pos.sequence')
+			Party = pool.get('party.party')
+			index = _LABEL_INDEX[database] = LabelIndex(
+				PosSequence._fields['invoice_type'].selection,
+				Party._fields['iva_condition'].selection)
+		return index
+
 	@classmethod
 	def parse(cls, report, records, data, localcontext):
 		pool = Pool()
 		User = pool.get('res.user')
 		Invoice = pool.get('account.invoice')
 
-		invoice = records[0]
-
+		# company values, computed once for all the invoices
 		user = User(Transaction().user)
 		localcontext['company'] = user.company
-		localcontext['barcode_img'] = cls._get_pyafipws_barcode_img(Invoice, invoice)
 		localcontext['condicion_iva'] = cls._get_condicion_iva(user.company)
 		localcontext['iibb_type'] = cls._get_iibb_type(user.company)
 		localcontext['vat_number'] = cls._get_vat_number(user.company)
-		localcontext['tipo_comprobante'] = cls._get_tipo_comprobante(Invoice, invoice)
-		localcontext['nombre_comprobante'] = cls._get_nombre_comprobante(Invoice, invoice)
-		localcontext['codigo_comprobante'] = cls._get_codigo_comprobante(Invoice, invoice)
-		localcontext['condicion_iva_cliente'] = cls._get_condicion_iva_cliente(Invoice, invoice)
-		localcontext['vat_number_cliente'] = cls._get_vat_number_cliente(Invoice, invoice)
-		localcontext['invoice_impuestos'] = cls._get_invoice_impuestos(Invoice, invoice)
-		localcontext['show_tax'] = cls._show_tax(Invoice, invoice)
-		localcontext['get_line_amount'] = cls.get_line_amount
+
+		# invoice values, by invoice id (the template prints all the records);
+		# the records are browsed together so their fields are read in bulk
+		for invoice in records:
+			values = cls._get_invoice_values(Invoice, invoice)
+			for name, value in values.iteritems():
+				localcontext.setdefault(name, {})[invoice.id] = value
+		localcontext['line_amounts'] = cls._get_line_amounts(records,
+			localcontext.get('tipo_comprobante', {}))
 		return super(InvoiceReport, cls).parse(report, records, data,
 				localcontext=localcontext)
 
 	@classmethod
-	def get_line_amount(self,tipo_comprobante, line_amount, line_taxes):
-		total = line_amount
-		if tipo_comprobante != 'A':
-			for tax in line_taxes:
-				if tax.tax.rate:
-					total = total + (line_amount * tax.tax.rate)
-				elif tax.tax.amount:
-					total = total + tax.tax.amount
-		return total
+	def export_pdf(cls, invoices, directory, processes=pdf_export.PROCESSES):
+		'''
+		Write the PDF of each invoice in the directory, with a manifest.
+		The reports are rendered here (one at a time, they use the database)
+		and converted meanwhile by a warm pool of office processes.
+		Returns the summary: throughput, latency and memory.
+		'''
+		def documents():
+			for invoice in invoices:
+				start = time.time()
+				extension, data = cls.execute([invoice.id], {})[:2]
+				yield {
+					'id': invoice.id,
+					'name': invoice.number or str(invoice.id),
+					'extension': extension,
+					'data': data,
+					'render': time.time() - start,
+					}
+		return pdf_export.export(documents(), directory,
+			pdf_export.get_pool(processes))
 
 	@classmethod
-	def _show_tax(cls, Invoice, invoice):
-		tipo_comprobante = cls._get_tipo_comprobante(Invoice, invoice)
-		if tipo_comprobante == 'A':
-			return True
-		else:
-			return False
+	def _get_invoice_values(cls, Invoice, invoice):
+		"Return the values printed for the invoice (one label lookup)"
+		label = cls._get_invoice_type_label(Invoice, invoice)
+		show_tax = label.letter == 'A'
+		return {
+			'barcode_img': cls._get_pyafipws_barcode_img(Invoice, invoice),
+			'tipo_comprobante': label.letter,
+			'nombre_comprobante': label.name,
+			'codigo_comprobante': label.code,
+			'condicion_iva_cliente': cls._get_condicion_iva_cliente(Invoice,
+				invoice),
+			'vat_number_cliente': cls._get_vat_number_cliente(Invoice, invoice),
+			'invoice_impuestos': (invoice.tax_amount if show_tax
+				else Decimal('00.00')),
+			'show_tax': show_tax,
+			}
 
 	@classmethod
-	def _get_invoice_impuestos(cls, Invoice, invoice):
-		tipo_comprobante = cls._get_tipo_comprobante(Invoice, invoice)
-		if tipo_comprobante == 'A':
-			return invoice.tax_amount
-		else:
-			return Decimal('00.00')
+	def _get_invoice_type_label(cls, Invoice, invoice):
+		"Return the code, letter and name of the invoice type"
+		invoice_type = invoice.invoice_type and invoice.invoice_type.invoice_type
+		return cls._get_label_index().invoice_type(invoice_type)
+
+	@classmethod
+	def _get_line_amounts(cls, invoices, tipos_comprobante):
+		'''
+		Return the amount printed for each line by id: taxes included, unless
+		the invoice is type A. The taxes of all the lines and their rates
+		are read at once.
+		'''
+		pool = Pool()
+		InvoiceLine = pool.get('account.invoice.line')
+		Tax = pool.get('account.tax')
+
+		lines = InvoiceLine.browse([l.id for i in invoices for l in i.lines
+				if l.type == 'line' and tipos_comprobante.get(i.id) != 'A'])
+		tax_ids = set(t.tax.id for l in lines for t in l.invoice_taxes
+			if t.tax)
+		rates = dict((t['id'], (t['rate'], t['amount']))
+			for t in Tax.read(list(tax_ids), ['rate', 'amount']))
+
+		amounts = {}
+		for invoice in invoices:
+			for line in invoice.lines:
+				if line.type == 'line':
+					amounts[line.id] = line.amount
+		for line in lines:
+			total = line.amount
+			for invoice_tax in line.invoice_taxes:
+				if not invoice_tax.tax:
+					continue
+				rate, amount = rates[invoice_tax.tax.id]
+				if rate:
+					total = total + (line.amount * rate)
+				elif amount:
+					total = total + amount
+			amounts[line.id] = total
+		return amounts
 
 	@classmethod
 	def _get_condicion_iva_cliente(cls, Invoice, invoice):
-		return dict(invoice.party._fields['iva_condition'].selection)[invoice.party.iva_condition]
+		return cls._get_label_index().iva_condition(invoice.party.iva_condition)
 
 	@classmethod
 	def _get_vat_number_cliente(cls, Invoice, invoice):
@@ -1145,27 +1735,6 @@ class InvoiceReport(Report):
 			return '%s-%s-%s' % (value[:2], value[2:-1], value[-1])
 		return ''
 
-	@classmethod
-	def _get_tipo_comprobante(cls, Invoice, invoice):
-		if hasattr(invoice.invoice_type, 'invoice_type') == True:
-			return dict(invoice.invoice_type._fields['invoice_type'].selection)[invoice.invoice_type.invoice_type][-1]
-		else:
-		   return ''
-
-	@classmethod
-	def _get_nombre_comprobante(cls, Invoice, invoice):
-		if hasattr(invoice.invoice_type, 'invoice_type') == True:
-			return dict(invoice.invoice_type._fields['invoice_type'].selection)[invoice.invoice_type.invoice_type][3:-2]
-		else:
-		   return ''
-
-	@classmethod
-	def _get_codigo_comprobante(cls, Invoice, invoice):
-		if hasattr(invoice.invoice_type, 'invoice_type') == True:
-			return dict(invoice.invoice_type._fields['invoice_type'].selection)[invoice.invoice_type.invoice_type][:2]
-		else:
-		   return ''
-
 	@classmethod
 	def _get_vat_number(cls, company):
 		value = company.party.vat_number
@@ -1173,7 +1742,7 @@ class InvoiceReport(Report):
 
 	@classmethod
 	def _get_condicion_iva(cls, company):
-		return dict(company.party._fields['iva_condition'].selection)[company.party.iva_condition]
+		return cls._get_label_index().iva_condition(company.party.iva_condition)
 
 	@classmethod
 	def _get_iibb_type(cls, company):
@@ -1182,18 +1751,7 @@ class InvoiceReport(Report):
 	@classmethod
 	def _get_pyafipws_barcode_img(cls, Invoice, invoice):
 		"Generate the required barcode Interleaved of 7 image using PIL"
-		from pyafipws.pyi25 import PyI25
-		from cStringIO import StringIO as StringIO
-		# create the helper:
-		pyi25 = PyI25()
-		output = StringIO()
 		if not invoice.pyafipws_barcode:
 			return
-		# call the helper:
-		bars = ''.join([c for c in invoice.pyafipws_barcode if c.isdigit()])
-		if not bars:
-			bars = "00"
-		pyi25.GenerarImagen(bars, output, basewidth=3, width=380, height=50, extension="PNG")
-		image = buffer(output.getvalue())
-		output.close()
-		return image
+		# rendered once per barcode (reprints and batch prints reuse it)
+		return buffer(afip_barcode.get_image(invoice.pyafipws_barcode))
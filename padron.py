@@ -0,0 +1,315 @@
+#! -*- coding: utf8 -*-
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+
+import datetime
+import json
+import logging
+
+from trytond import backend
+from trytond.model import ModelView, ModelSQL, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from . import afip_padron, padron_snapshot
+
+__all__ = ['AfipPadron', 'AfipPadronEntry']
+
+SNAPSHOT_CHUNK_SIZE = 1000  # snapshot lines written (and entries read) at once
+
+
+class AfipPadron(ModelSQL, ModelView):
+    'AFIP Padron Cache'
+    __name__ = 'account_invoice_ar.afip_padron'
+
+    vat_number = fields.Char('CUIT', required=True, select=True, readonly=True)
+    found = fields.Boolean('Encontrado', readonly=True)
+    data = fields.Text('Datos', readonly=True)
+    expires = fields.DateTime('Vence', required=True, select=True,
+        readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(AfipPadron, cls).__setup__()
+        cls._sql_constraints += [
+            ('vat_number_uniq', 'UNIQUE(vat_number)',
+                'The CUIT must be unique.'),
+            ]
+        cls._error_messages.update({
+                'padron_error': u'No se pudo consultar el padrón de AFIP '
+                    u'(%s).',
+                })
+
+    @classmethod
+    def lookup(cls, vat_number):
+        '''
+        Return the padron data of the CUIT (None if it does not exist).
+        If AFIP can not be queried, the entry of the local snapshot is used.
+        '''
+        Entry = Pool().get('account_invoice_ar.afip_padron.entry')
+        vat_number = afip_padron.normalize(vat_number)
+        data = cls.lookup_many([vat_number])[vat_number]
+        if isinstance(data, afip_padron.PadronError):
+            entry = Entry.get_entry(vat_number, removed=True)
+            if entry is None:
+                cls.raise_user_error('padron_error', unicode(data))
+            data = entry.get_afip_dict()
+        return data
+
+    @classmethod
+    def lookup_many(cls, vat_numbers):
+        '''
+        Return {CUIT: padron data} (None if it does not exist, PadronError if
+        it could not be queried). They are looked up in memory, then in the
+        table and then in AFIP (concurrently); the answers, also "not found",
+        are kept until they expire.
+        '''
+        cursor = Transaction().cursor
+        logger = logging.getLogger('padron')
+        result = {}
+        missing = []
+        for vat_number in set(afip_padron.normalize(v) for v in vat_numbers):
+            hit, data = afip_padron.get_cached(vat_number)
+            if hit:
+                result[vat_number] = data
+            else:
+                missing.append(vat_number)
+        if not missing:
+            return result
+
+        now = datetime.datetime.now()
+        records = {}
+        for i in range(0, len(missing), cursor.IN_MAX):
+            for record in cls.search([
+                        ('vat_number', 'in', missing[i:i + cursor.IN_MAX]),
+                        ]):
+                records[record.vat_number] = record
+        to_fetch = []
+        for vat_number in missing:
+            record = records.get(vat_number)
+            if record and record.expires > now:
+                data = json.loads(record.data) if record.found else None
+                afip_padron.remember(vat_number, data,
+                    (record.expires - now).total_seconds())
+                result[vat_number] = data
+            else:
+                to_fetch.append(vat_number)
+
+        answers = {}
+        for vat_number, data in afip_padron.lookup_many(to_fetch).iteritems():
+            result[vat_number] = data
+            if isinstance(data, afip_padron.PadronError):
+                logger.warning(u'Padrón AFIP %s: %s', vat_number, data)
+                continue
+            ttl = (afip_padron.TTL if data is not None
+                else afip_padron.NOT_FOUND_TTL)
+            answers[vat_number] = (data is not None,
+                json.dumps(data) if data is not None else None,
+                now + datetime.timedelta(seconds=ttl))
+        if answers:
+            cls._store(answers)
+        return result
+
+    @classmethod
+    def _store(cls, answers):
+        '''
+        Save the answers {CUIT: (found, data, expires)} in a cursor of their
+        own: the stored CUITs are updated and the others inserted. When a
+        concurrent lookup inserts the same CUIT first, it is saved again as
+        an update, the transaction of the user is never aborted.
+        '''
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+        table = cls.__table__()
+        logger = logging.getLogger('padron')
+        uid = Transaction().user
+        vat_numbers = list(answers)
+        with Transaction().new_cursor():
+            cursor = Transaction().cursor
+            for _ in range(2):
+                now = datetime.datetime.now()
+                try:
+                    existing = set()
+                    for i in range(0, len(vat_numbers), cursor.IN_MAX):
+                        cursor.execute(*table.select(table.vat_number,
+                                where=table.vat_number.in_(
+                                    vat_numbers[i:i + cursor.IN_MAX])))
+                        existing.update(r[0] for r in cursor.fetchall())
+                    to_insert = []
+                    for vat_number, values in answers.iteritems():
+                        if vat_number in existing:
+                            cursor.execute(*table.update([table.found,
+                                        table.data, table.expires,
+                                        table.write_uid, table.write_date],
+                                    list(values) + [uid, now],
+                                    where=table.vat_number == vat_number))
+                        else:
+                            to_insert.append([vat_number] + list(values)
+                                + [uid, now])
+                    if to_insert:
+                        cursor.execute(*table.insert([table.vat_number,
+                                    table.found, table.data, table.expires,
+                                    table.create_uid, table.create_date],
+                                to_insert))
+                except DatabaseIntegrityError:
+                    cursor.rollback()
+                    continue
+                cursor.commit()
+                return
+        logger.warning(u'Padrón AFIP: no se pudo guardar la consulta de %s',
+            u', '.join(vat_numbers))
+
+    @classmethod
+    def purge(cls):
+        "Delete the expired entries (cron)"
+        cls.delete(cls.search([
+                    ('expires', '<', datetime.datetime.now()),
+                    ]))
+
+
+class AfipPadronEntry(ModelSQL, ModelView):
+    'AFIP Padron Snapshot Entry'
+    __name__ = 'account_invoice_ar.afip_padron.entry'
+
+    vat_number = fields.Char('CUIT', required=True, select=True, readonly=True)
+    name = fields.Char('Nombre', readonly=True)
+    iva_condition = fields.Selection([
+            ('', ''),
+            ('responsable_inscripto', 'Responsable Inscripto'),
+            ('exento', 'Exento'),
+            ('consumidor_final', 'Consumidor Final'),
+            ('monotributo', 'Monotributo'),
+            ('no_alcanzado', 'No alcanzado'),
+            ], 'Condicion ante el IVA', readonly=True)
+    activity_code = fields.Char('Actividad', readonly=True)
+    state = fields.Selection([
+            ('active', 'Activo'),
+            ('removed', 'Dado de baja'),
+            ], 'Estado', required=True, select=True, readonly=True)
+    digest = fields.Char('Digest', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(AfipPadronEntry, cls).__setup__()
+        cls._sql_constraints += [
+            ('vat_number_uniq', 'UNIQUE(vat_number)',
+                'The CUIT must be unique.'),
+            ]
+
+    @staticmethod
+    def default_state():
+        return 'active'
+
+    @classmethod
+    def get_entry(cls, vat_number, removed=False):
+        "Return the active (or removed) entry of the CUIT in the local snapshot"
+        domain = [
+            ('vat_number', '=', afip_padron.normalize(vat_number)),
+            ]
+        if not removed:
+            domain.append(('state', '=', 'active'))
+        entries = cls.search(domain, limit=1)
+        return entries[0] if entries else None
+
+    def get_afip_dict(self):
+        '''
+        The entry as the data of the padron webservice, plus its
+        iva_condition. The snapshot has neither address nor registration
+        date (and maybe no activity): those keys are left out, so the
+        current values of the party are kept.
+        '''
+        data = {
+            'idPersona': int(self.vat_number),
+            'nombre': self.name,
+            'estadoClave': 'ACTIVO' if self.state == 'active' else 'INACTIVO',
+            }
+        if self.activity_code and self.activity_code.isdigit() and int(
+                self.activity_code):
+            data['actividades'] = [int(self.activity_code)]
+        if self.iva_condition:
+            data['iva_condition'] = self.iva_condition
+        return data
+
+    @classmethod
+    def _get_entries(cls):
+        "Yield (CUIT, digest) of the stored entries by CUIT, a chunk at a time"
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        last = ''
+        while True:
+            cursor.execute(*table.select(table.vat_number, table.digest,
+                    table.state, where=table.vat_number > last,
+                    order_by=table.vat_number.asc,
+                    limit=SNAPSHOT_CHUNK_SIZE))
+            rows = cursor.fetchall()
+            for vat_number, digest, state in rows:
+                yield vat_number, digest if state == 'active' else None
+            if len(rows) < SNAPSHOT_CHUNK_SIZE:
+                break
+            last = rows[-1][0]
+
+    @classmethod
+    def import_snapshot(cls, path=None):
+        '''
+        Load the padron snapshot file (or the changes of a newer one) into
+        the local table (cron). The file is read a line at a time and merged
+        with the stored entries, only the new, changed and removed CUITs are
+        written; each chunk is committed.
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        logger = logging.getLogger('padron')
+        path = path or padron_snapshot.SNAPSHOT_PATH
+        uid = Transaction().user
+        counts = dict.fromkeys(['new', 'changed', 'removed', 'unchanged'], 0)
+        errors = []
+        to_create = []
+        pending = [0]
+
+        def flush():
+            now = datetime.datetime.now()
+            if to_create:
+                cursor.execute(*table.insert([table.vat_number, table.name,
+                            table.iva_condition, table.activity_code,
+                            table.digest, table.state, table.create_uid,
+                            table.create_date],
+                        [[c, v['name'], v['iva_condition'],
+                                v['activity_code'], v['digest'], 'active',
+                                uid, now] for c, v in to_create]))
+                del to_create[:]
+            cursor.commit()
+            pending[0] = 0
+
+        with open(path, 'rb') as snapshot:
+            for change, vat_number, values in padron_snapshot.diff(
+                    padron_snapshot.read(snapshot, errors), cls._get_entries()):
+                counts[change] += 1
+                if change == 'unchanged':
+                    continue
+                now = datetime.datetime.now()
+                if change == 'new':
+                    to_create.append((vat_number, values))
+                elif change == 'changed':
+                    cursor.execute(*table.update([table.name,
+                                table.iva_condition, table.activity_code,
+                                table.digest, table.state, table.write_uid,
+                                table.write_date],
+                            [values['name'], values['iva_condition'],
+                                values['activity_code'], values['digest'],
+                                'active', uid, now],
+                            where=table.vat_number == vat_number))
+                else:
+                    cursor.execute(*table.update([table.state,
+                                table.write_uid, table.write_date],
+                            ['removed', uid, now],
+                            where=table.vat_number == vat_number))
+                pending[0] += 1
+                if pending[0] >= SNAPSHOT_CHUNK_SIZE:
+                    flush()
+        flush()
+        for number, error in errors[:10]:
+            logger.warning(u'Padrón AFIP %s línea %d: %s', path, number, error)
+        logger.info(u'Padrón AFIP %s: %d nuevos, %d modificados, %d bajas, '
+            u'%d sin cambios, %d errores', path, counts['new'],
+            counts['changed'], counts['removed'], counts['unchanged'],
+            len(errors))
+        return counts
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the Affero GNU General Public License as published by
+# the Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+"Streaming reader of the AFIP padron snapshot (fixed width) and its diffs"
+
+__license__ = "AGPL 3.0"
+
+import hashlib
+
+
+SNAPSHOT_PATH = "/var/lib/trytond/afip/padron.txt"
+ENCODING = "latin-1"
+# "padron de contribuyentes" (apellido y nombre, denominacion), sorted by CUIT
+LAYOUT = [
+    ('cuit', 0, 11),
+    ('denominacion', 11, 30),
+    ('ganancias', 41, 2),
+    ('iva', 43, 2),
+    ('monotributo', 45, 2),
+    ('integrante_soc', 47, 1),
+    ('empleador', 48, 1),
+    ('actividad_monotributo', 49, 2),
+]
+LINE_SIZE = 51
+
+
+def parse_line(line):
+    "Return the fields of the line (unicode, stripped)"
+    line = line.rstrip('\r\n').decode(ENCODING)
+    if len(line) < LINE_SIZE:
+        raise ValueError(u"Linea incompleta: %r" % line)
+    row = dict((name, line[start:start + size].strip())
+               for name, start, size in LAYOUT)
+    if not row['cuit'].isdigit():
+        raise ValueError(u"CUIT invalido: %r" % row['cuit'])
+    return row
+
+
+def get_iva_condition(row):
+    "Return the iva_condition of party.party of the row"
+    if row['iva'] in ('AC', 'AN'):
+        return 'responsable_inscripto'
+    elif row['monotributo'] and row['monotributo'] != 'NI':
+        return 'monotributo'
+    elif row['iva'] == 'EX':
+        return 'exento'
+    elif row['iva'] in ('NA', 'XN'):
+        return 'no_alcanzado'
+    return ''
+
+
+def get_values(row):
+    "Return the values of the local padron entry of the row"
+    return {
+        'name': row['denominacion'],
+        'iva_condition': get_iva_condition(row),
+        'activity_code': row['actividad_monotributo'],
+        # of the fields read, to find the entries changed by a new snapshot
+        'digest': hashlib.sha1(u'|'.join(row[name] for name, _, _ in LAYOUT
+                                         ).encode('utf-8')).hexdigest(),
+    }
+
+
+def read(lines, errors=None):
+    '''Yield (cuit, values) of the snapshot lines, one at a time.
+
+    The CUITs must be in ascending order (as AFIP publishes them), the
+    invalid lines are skipped and appended to the errors list.
+    '''
+    last = None
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            row = parse_line(line)
+        except ValueError, e:
+            if errors is not None:
+                errors.append((number, unicode(e)))
+            continue
+        cuit = row['cuit']
+        if last is not None and cuit <= last:
+            raise ValueError(u"Padron no ordenado por CUIT en la linea %d"
+                             % number)
+        last = cuit
+        yield cuit, get_values(row)
+
+
+def diff(snapshot, entries):
+    '''Yield the changes of the stored entries in the new snapshot.
+
+    snapshot yields (cuit, values) and entries (cuit, digest) of the stored
+    entries (digest None for the removed ones), both in ascending order, so
+    they are merged with constant memory. The changes are ('new', cuit,
+    values), ('changed', cuit, values) and ('removed', cuit, None); the
+    unchanged entries yield ('unchanged', cuit, None).
+    '''
+    entries = iter(entries)
+    entry = next(entries, None)
+    for cuit, values in snapshot:
+        while entry is not None and entry[0] < cuit:
+            if entry[1] is not None:
+                yield 'removed', entry[0], None
+            entry = next(entries, None)
+        if entry is not None and entry[0] == cuit:
+            if entry[1] == values['digest']:
+                yield 'unchanged', cuit, None
+            else:
+                yield 'changed', cuit, values
+            entry = next(entries, None)
+        else:
+            yield 'new', cuit, values
+    while entry is not None:
+        if entry[1] is not None:
+            yield 'removed', entry[0], None
+        entry = next(entries, None)
+
+
+if __name__ == '__main__':
+    # benchmark: read and diff a synthetic snapshot against the previous one
+    import collections
+    import resource
+    import sys
+    import time
+
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    def snapshot(version):
+        for i in xrange(number):
+            if version and i % 100 == 0:
+                continue                        # removed
+            iva = 'AC' if i % 3 else 'NI'
+            if version and i % 50 == 1:
+                iva = 'EX'                      # changed
+            yield "%011d%-30s%-2s%-2s%-2s%s%s%-2s\n" % (
+                20000000000 + i * 7, "CONTRIBUYENTE %d" % i, "AC", iva,
+                "NI" if i % 3 else "B ", "N", "S", "00" if i % 3 else "07")
+
+    start = time.time()
+    stored = [(cuit, values['digest']) for cuit, values in read(snapshot(0))]
+    print "read %d lines: %.2f s" % (number, time.time() - start)
+    start = time.time()
+    counts = collections.Counter(change for change, _, _ in
+                                 diff(read(snapshot(1)), stored))
+    print "diff: %.2f s %s" % (time.time() - start, dict(counts))
+    print "memory max: %d KB" % (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
@@ -1,16 +1,31 @@
 #! -*- coding: utf8 -*-
+import collections
+import datetime
+import logging
+import sys
+from contextlib import contextmanager
+
+from sql import Column, Table
+from sql.aggregate import Count
+
+from trytond import backend
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pyson import Bool, Eval, Equal, Not, And
 from trytond.pool   import Pool
 from trytond.report import Report
+from trytond.exceptions import UserError
 from trytond.transaction import Transaction
-from urllib2 import urlopen
-from json import loads, dumps
 
-from actividades import CODES
+from . import afip_padron
+from .activity_codes import CURRENT_VERSION as CURRENT_ACTIVITY_VERSION
 
-__all__ = ['Party', 'GetAFIPData', 'GetAFIPDataStart']
+__all__ = ['Party', 'GetAFIPData', 'GetAFIPDataStart',
+    'EnrichFromAFIPResult', 'EnrichFromAFIP']
+
+AFIP_ENRICH_LIMIT = 500     # parties updated by each call of the cron
+AFIP_ENRICH_INTERVAL = 7    # days until the cron checks a party again
+VAT_NUMBER_INDEX = 'party_party_vat_number_uniq'
 
 TIPO_DOCUMENTO = [
     ('0', 'CI Policia Federal'),
@@ -117,20 +132,24 @@ class Party(ModelSQL, ModelView):
                 },
             depends=['active'],
             )
-    primary_activity_code = fields.Selection(CODES,
+    primary_activity_code = fields.Many2One('account_invoice_ar.activity',
             'Primary Activity Code',
+            domain=[('version', '=', CURRENT_ACTIVITY_VERSION)],
             states={
                 'readonly': ~Eval('active', True),
                 },
             depends=['active'],
             )
-    secondary_activity_code = fields.Selection(CODES,
+    secondary_activity_code = fields.Many2One('account_invoice_ar.activity',
             'Secondary Activity Code',
+            domain=[('version', '=', CURRENT_ACTIVITY_VERSION)],
             states={
                 'readonly': ~Eval('active', True),
                 },
             depends=['active'],
             )
+    afip_checked = fields.DateTime('Consultado en AFIP', readonly=True,
+        help=u'Última consulta del padrón de AFIP (actualización periódica).')
     start_activity_date = fields.Date('Start activity date',
             states={
                 'readonly': ~Eval('active', True),
@@ -142,7 +161,8 @@ class Party(ModelSQL, ModelView):
             'readonly': ~Eval('active', True),
             'required': And(Bool(Eval('vat_country')), Not(Equal(Eval('iva_condition'), 'consumidor_final'))),
             },
-        depends=['active', 'vat_country', 'iva_condition'])
+        depends=['active', 'vat_country', 'iva_condition'],
+        on_change=['vat_number', 'name', 'iva_condition'])
     controlling_entity = fields.Char('Entidad controladora', help="Controlling entity",
         states={
             'readonly': ~Eval('active', True),
@@ -171,22 +191,196 @@ class Party(ModelSQL, ModelView):
             'get_afip_data': {},
         })
         cls._error_messages.update({
-            'unique_vat_number': 'The VAT number must be unique in each country.',
+            'unique_vat_number': ('The VAT number "%(vat_number)s" must be '
+                'unique in each country (%(parties)s).'),
             'vat_number_not_found': 'El CUIT no ha sido encontrado',
         })
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        if TableHandler.table_exist(cursor, cls._table):
+            table = TableHandler(cursor, cls, module_name)
+            # migration: the activity codes were stored as selection values
+            for name in ('primary_activity_code', 'secondary_activity_code'):
+                if (table.column_exist(name)
+                        and table._columns[name]['typname'].lower()
+                        == 'varchar'):
+                    table.column_rename(name, name + '_char')
+        super(Party, cls).__register__(module_name)
+
+        table = TableHandler(cursor, cls, module_name)
+        if table.column_exist('primary_activity_code_char'):
+            cls._migrate_activity_codes()
+            table.drop_column('primary_activity_code_char')
+            table.drop_column('secondary_activity_code_char')
+        cls._create_vat_number_index()
+
+    @classmethod
+    def _migrate_activity_codes(cls):
+        "Point the activity codes stored as text to account_invoice_ar.activity"
+        Activity = Pool().get('account_invoice_ar.activity')
+        cursor = Transaction().cursor
+        party = cls.__table__()
+        activity = Activity.__table__()
+        cursor.execute(*activity.select(activity.code, activity.id,
+                where=activity.version == CURRENT_ACTIVITY_VERSION))
+        activities = dict(cursor.fetchall())
+        for name in ('primary_activity_code', 'secondary_activity_code'):
+            column = Column(party, name)
+            old_column = Column(party, name + '_char')
+            cursor.execute(*party.select(old_column,
+                    where=(old_column != None) & (old_column != ''),
+                    group_by=old_column))
+            for code, in cursor.fetchall():
+                if code in activities:
+                    cursor.execute(*party.update([column],
+                            [activities[code]], where=old_column == code))
+
+    @classmethod
+    def _create_vat_number_index(cls):
+        '''
+        Unique index on the VAT number and country of the active parties
+        (a partial index, it can not be declared in _sql_constraints).
+        If there are duplicated parties it is created on the next update.
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        name = VAT_NUMBER_INDEX
+        if backend.name() == 'postgresql':
+            indexes = Table('pg_indexes')
+            cursor.execute(*indexes.select(indexes.indexname,
+                    where=indexes.indexname == name))
+        elif backend.name() == 'sqlite':
+            indexes = Table('sqlite_master')
+            cursor.execute(*indexes.select(indexes.name,
+                    where=(indexes.type == 'index') & (indexes.name == name)))
+        else:
+            return
+        if cursor.fetchone():
+            return
+        cursor.execute('SAVEPOINT vat_number_uniq')
+        try:
+            cursor.execute('CREATE UNIQUE INDEX "%s" ON "%s" '
+                '(vat_country, vat_number) WHERE active '
+                'AND vat_number IS NOT NULL AND vat_number != \'\''
+                % (name, cls._table))
+        except Exception:
+            cursor.execute('ROLLBACK TO SAVEPOINT vat_number_uniq')
+            cursor.execute(*table.select(table.vat_country, table.vat_number,
+                    where=(table.active == True) & (table.vat_number != None)
+                    & (table.vat_number != ''),
+                    group_by=[table.vat_country, table.vat_number],
+                    having=Count(table.id) > 1))
+            duplicates = ['%s %s' % row for row in cursor.fetchall()]
+            logging.getLogger('party').error('Unable to add the unique '
+                'index on the VAT number, it is only checked by validate. '
+                'Fix the duplicated active parties and update the module: '
+                '%s', ', '.join(duplicates[:50]))
+        else:
+            cursor.execute('RELEASE SAVEPOINT vat_number_uniq')
+
+    @classmethod
+    def create(cls, vlist):
+        def get_keys():
+            return [(v.get('vat_country', cls.default_vat_country()),
+                    v.get('vat_number'), v.get('name')) for v in vlist], []
+        with cls._check_vat_number_index(get_keys):
+            return super(Party, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        def get_keys():
+            keys, ids = [], []
+            actions = iter(args)
+            for parties, values in zip(actions, actions):
+                for party in parties:
+                    keys.append((values.get('vat_country', party.vat_country),
+                            values.get('vat_number', party.vat_number),
+                            party.rec_name))
+                    ids.append(party.id)
+            return keys, ids
+        with cls._check_vat_number_index(get_keys):
+            super(Party, cls).write(*args)
+
+    @classmethod
+    @contextmanager
+    def _check_vat_number_index(cls, get_keys):
+        '''
+        Raise the unique_vat_number error instead of the integrity error of
+        the unique index (raised before validate). get_keys returns the
+        (country, number, name) of the parties written and the ids of the
+        existing ones, it is only called when the index fails.
+        '''
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+        cursor = Transaction().cursor
+        cursor.execute('SAVEPOINT vat_number_index')
+        try:
+            yield
+        except DatabaseIntegrityError, e:
+            exc_info = sys.exc_info()
+            message = unicode(e)
+            if (VAT_NUMBER_INDEX not in message
+                    and 'vat_number' not in message):
+                raise
+            cursor.execute('ROLLBACK TO SAVEPOINT vat_number_index')
+            keys, ids = get_keys()
+            names = collections.defaultdict(list)
+            for vat_country, vat_number, name in keys:
+                if vat_number:
+                    names[(vat_country, vat_number)].append(name)
+            for party in cls.search([
+                        ('vat_number', 'in', list(set(
+                                    n for _, n in names))),
+                        ('id', 'not in', ids),
+                        ]):
+                key = (party.vat_country, party.vat_number)
+                if key in names:
+                    names[key].append(party.rec_name)
+            for (vat_country, vat_number), parties in names.iteritems():
+                if len(parties) > 1:
+                    cls.raise_user_error('unique_vat_number', {
+                            'vat_number': vat_number,
+                            'parties': ', '.join(parties),
+                            })
+            raise exc_info[0], exc_info[1], exc_info[2]
+        else:
+            cursor.execute('RELEASE SAVEPOINT vat_number_index')
+
     @classmethod
     def validate(cls, parties):
         for party in parties:
             if party.iva_condition != u'consumidor_final' and bool(party.vat_number):
                 party.check_vat()
+        cls.check_vat_number_unique(parties)
 
-            if bool(party.vat_number) and bool(party.vat_country):
-                data = cls.search([('vat_number','=', party.vat_number),
-                                   ('vat_country','=', party.vat_country),
-                                   ])
-                if len(data) != 1:
-                    cls.raise_user_error('unique_vat_number')
+    @classmethod
+    def check_vat_number_unique(cls, parties):
+        "Check the VAT numbers of the parties with one query per batch"
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        keys = set((p.vat_country, p.vat_number) for p in parties
+            if p.vat_number and p.vat_country)
+        numbers = list(set(n for _, n in keys))
+        for i in range(0, len(numbers), cursor.IN_MAX):
+            sub_numbers = numbers[i:i + cursor.IN_MAX]
+            cursor.execute(*table.select(table.vat_country, table.vat_number,
+                    where=(table.active == True)
+                    & table.vat_number.in_(sub_numbers),
+                    group_by=[table.vat_country, table.vat_number],
+                    having=Count(table.id) > 1))
+            for vat_country, vat_number in cursor.fetchall():
+                if (vat_country, vat_number) not in keys:
+                    continue
+                duplicates = cls.search([
+                        ('vat_number', '=', vat_number),
+                        ('vat_country', '=', vat_country),
+                        ])
+                cls.raise_user_error('unique_vat_number', {
+                        'vat_number': vat_number,
+                        'parties': ', '.join(p.rec_name for p in duplicates),
+                        })
 
     # Button de AFIP
     @classmethod
@@ -194,6 +388,183 @@ class Party(ModelSQL, ModelView):
     def get_afip_data(cls, parties):
         pass
 
+    def on_change_vat_number(self):
+        "Nombre y condicion de IVA del padron local, sin consultar AFIP"
+        AfipPadronEntry = Pool().get('account_invoice_ar.afip_padron.entry')
+        res = {}
+        if not self.vat_number:
+            return res
+        entry = AfipPadronEntry.get_entry(self.vat_number)
+        if entry:
+            if not self.name:
+                res['name'] = entry.name
+            if not self.iva_condition and entry.iva_condition:
+                res['iva_condition'] = entry.iva_condition
+        return res
+
+    @staticmethod
+    def get_afip_activity_codes(afip_dict):
+        "Actividades (ids) del padron que existen en el nomenclador vigente"
+        Activity = Pool().get('account_invoice_ar.activity')
+        codes = ['%06d' % int(c) for c in afip_dict.get('actividades') or []]
+        activities = Activity.get_ids(codes)
+        return [activities[c] for c in codes if c in activities]
+
+    @classmethod
+    def _get_afip_values(cls, afip_dict):
+        "Valores de party.party y party.address de los datos del padron"
+        codes = cls.get_afip_activity_codes(afip_dict)
+        fecha = afip_dict.get('fechaInscripcion')
+        domicilio = afip_dict.get('domicilioFiscal') or {}
+        values = {
+            'name': afip_dict['nombre'],
+            'vat_country': 'AR',
+            'primary_activity_code': codes[0] if len(codes) >= 1 else None,
+            'secondary_activity_code': codes[1] if len(codes) >= 2 else None,
+            'start_activity_date': (datetime.datetime.strptime(fecha,
+                    '%Y-%m-%d').date() if fecha else None),
+            'active': afip_dict.get('estadoClave') == 'ACTIVO',
+            }
+        address = {
+            'name': afip_dict['nombre'],
+            'street': domicilio.get('direccion'),
+            'zip': domicilio.get('codPostal'),
+            }
+        return values, address
+
+    @classmethod
+    def enrich_from_afip(cls, parties=None):
+        '''
+        Update the parties with the data of the AFIP padron, queried
+        concurrently, and write them at once. Without parties (cron) the
+        argentinian ones without activity code are updated.
+        The parties answered by AFIP are marked as checked, so the cron skips
+        the ones that could not be completed (not found, without activity in
+        the current nomenclator) for AFIP_ENRICH_INTERVAL days; the ones that
+        could not be queried are retried on the next call.
+        Returns the changed, unchanged and failed (party, message) parties.
+        '''
+        pool = Pool()
+        AfipPadron = pool.get('account_invoice_ar.afip_padron')
+        logger = logging.getLogger('padron')
+
+        now = datetime.datetime.now()
+        if parties is None:
+            checked = now - datetime.timedelta(days=AFIP_ENRICH_INTERVAL)
+            parties = cls.search([
+                    ('vat_country', '=', 'AR'),
+                    ('vat_number', '!=', None),
+                    ('primary_activity_code', '=', None),
+                    ['OR',
+                        ('afip_checked', '=', None),
+                        ('afip_checked', '<', checked),
+                        ],
+                    ], order=[('id', 'ASC')], limit=AFIP_ENRICH_LIMIT)
+        report = {
+            'changed': [],
+            'unchanged': [],
+            'failed': [],
+            }
+        parties = [p for p in parties if p.vat_number]
+        padron = AfipPadron.lookup_many([p.vat_number for p in parties])
+
+        changes = []
+        for party in parties:
+            afip_dict = padron[afip_padron.normalize(party.vat_number)]
+            if isinstance(afip_dict, afip_padron.PadronError):
+                report['failed'].append((party, unicode(afip_dict)))
+                continue
+            checked = {'afip_checked': now}
+            if afip_dict is None:
+                report['failed'].append((party,
+                        cls._error_messages['vat_number_not_found']))
+                changes.append((party, checked, None, None))
+                continue
+            try:
+                values, address_values = cls._get_afip_values(afip_dict)
+            except (KeyError, TypeError, ValueError), e:
+                report['failed'].append((party, unicode(e)))
+                changes.append((party, checked, None, None))
+                continue
+            values = dict((k, v) for k, v in values.iteritems()
+                if (getattr(getattr(party, k), 'id', getattr(party, k))
+                    or None) != (v or None))
+            # the address is only filled if it is missing
+            address = party.addresses[0] if party.addresses else None
+            if address is not None and address.street:
+                address_values = None
+            if values or address_values:
+                report['changed'].append(party)
+            else:
+                report['unchanged'].append(party)
+            values.update(checked)
+            changes.append((party, values, address, address_values))
+
+        for party, message in cls._save_afip_values(changes):
+            for name in ('changed', 'unchanged'):
+                if party in report[name]:
+                    report[name].remove(party)
+            if party not in [p for p, _ in report['failed']]:
+                report['failed'].append((party, message))
+        logger.info(u'Padrón AFIP: %d actualizadas, %d sin cambios, '
+            u'%d fallidas', len(report['changed']), len(report['unchanged']),
+            len(report['failed']))
+        return report
+
+    @classmethod
+    def _save_afip_values(cls, changes):
+        '''
+        Write the changes (party, values, address, address values) at once.
+        If a party is not valid (i.e. its CUIT is repeated) they are written
+        one at a time instead, skipping the invalid parties.
+        Returns the failed (party, message).
+        '''
+        Address = Pool().get('party.address')
+        DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+        cursor = Transaction().cursor
+
+        def save(changes):
+            to_write = []
+            addresses_to_create = []
+            addresses_to_write = []
+            for party, values, address, address_values in changes:
+                to_write.extend(([party], values))
+                if address_values is None:
+                    continue
+                elif address is None:
+                    addresses_to_create.append(dict(address_values,
+                            party=party.id))
+                else:
+                    addresses_to_write.extend(([address], address_values))
+            if to_write:
+                cls.write(*to_write)
+            if addresses_to_create:
+                Address.create(addresses_to_create)
+            if addresses_to_write:
+                Address.write(*addresses_to_write)
+
+        if not changes:
+            return []
+        cursor.execute('SAVEPOINT enrich_from_afip')
+        try:
+            save(changes)
+        except (UserError, DatabaseIntegrityError):
+            cursor.execute('ROLLBACK TO SAVEPOINT enrich_from_afip')
+        else:
+            cursor.execute('RELEASE SAVEPOINT enrich_from_afip')
+            return []
+        failed = []
+        for change in changes:
+            cursor.execute('SAVEPOINT enrich_from_afip_party')
+            try:
+                save([change])
+            except (UserError, DatabaseIntegrityError), e:
+                cursor.execute('ROLLBACK TO SAVEPOINT enrich_from_afip_party')
+                failed.append((change[0], unicode(e.message)))
+            else:
+                cursor.execute('RELEASE SAVEPOINT enrich_from_afip_party')
+        return failed
+
 
 class GetAFIPDataStart(ModelView):
     'Get AFIP Data Start'
@@ -203,9 +574,19 @@ class GetAFIPDataStart(ModelView):
     direccion = fields.Char('Direccion', readonly=True)
     codigo_postal = fields.Char('Codigo Postal', readonly=True)
     fecha_inscripcion = fields.Char('Fecha de Inscripcion', readonly=True)
-    primary_activity_code = fields.Selection(CODES, 'Actividad primaria', readonly=True)
-    secondary_activity_code = fields.Selection(CODES, 'Actividad secundaria', readonly=True)
+    primary_activity_code = fields.Many2One('account_invoice_ar.activity',
+        'Actividad primaria', readonly=True)
+    secondary_activity_code = fields.Many2One('account_invoice_ar.activity',
+        'Actividad secundaria', readonly=True)
     estado = fields.Char('Estado', readonly=True)
+    iva_condition = fields.Selection([
+            ('', ''),
+            ('responsable_inscripto', 'Responsable Inscripto'),
+            ('exento', 'Exento'),
+            ('consumidor_final', 'Consumidor Final'),
+            ('monotributo', 'Monotributo'),
+            ('no_alcanzado', 'No alcanzado'),
+            ], 'Condicion ante el IVA', readonly=True)
 
 class GetAFIPData(Wizard):
     'Get AFIP Data'
@@ -225,17 +606,31 @@ class GetAFIPData(Wizard):
         party = Party(Transaction().context['active_id'])
         if party:
             afip_dict = self.get_json(party.vat_number)
-            activ  = afip_dict['actividades']
-            activ1 = str(activ[0]) if len(activ) >= 1 else ''
-            activ2 = str(activ[1]) if len(activ) >= 2 else ''
+            if afip_dict is None:
+                Party.raise_user_error('vat_number_not_found')
+            # the local snapshot (AFIP down) has neither address nor date,
+            # and maybe no activity: the current values of the party are kept
+            if 'actividades' in afip_dict:
+                activ  = Party.get_afip_activity_codes(afip_dict)
+                activ1 = activ[0] if len(activ) >= 1 else None
+                activ2 = activ[1] if len(activ) >= 2 else None
+            else:
+                activ1 = (party.primary_activity_code.id
+                    if party.primary_activity_code else None)
+                activ2 = (party.secondary_activity_code.id
+                    if party.secondary_activity_code else None)
+            domicilio = afip_dict.get('domicilioFiscal') or {}
             res = {
                 'nombre': afip_dict['nombre'],
-                'direccion': afip_dict['domicilioFiscal']['direccion'],
-                'codigo_postal': afip_dict['domicilioFiscal']['codPostal'],
-                'fecha_inscripcion': afip_dict['fechaInscripcion'],
+                'direccion': domicilio.get('direccion'),
+                'codigo_postal': domicilio.get('codPostal'),
+                'fecha_inscripcion': afip_dict.get('fechaInscripcion'),
                 'primary_activity_code': activ1,
                 'secondary_activity_code': activ2,
-                'estado': afip_dict['estadoClave']
+                'estado': afip_dict.get('estadoClave') or (
+                    'ACTIVO' if party.active else 'INACTIVO'),
+                'iva_condition': afip_dict.get('iva_condition',
+                    party.iva_condition),
             }
 
         return res
@@ -248,17 +643,19 @@ class GetAFIPData(Wizard):
 
         import datetime
         # formato de fecha: AAAA-MM-DD
-        fecha = self.start.fecha_inscripcion.split('-')
-        if len(fecha) == 3 and len(fecha) == 3:
+        fecha = (self.start.fecha_inscripcion or '').split('-')
+        if len(fecha) == 3:
             year = int(fecha[0])
             month = int(fecha[1])
             day = int(fecha[2])
+            party.start_activity_date = datetime.date(year, month, day)
 
         party.name = self.start.nombre
         party.primary_activity_code = self.start.primary_activity_code
         party.secondary_activity_code = self.start.secondary_activity_code
         party.vat_country = 'AR'
-        party.start_activity_date = datetime.date(year, month, day)
+        if self.start.iva_condition:
+            party.iva_condition = self.start.iva_condition
         if self.start.estado == 'ACTIVO':
             party.active = True
         else:
@@ -268,7 +665,10 @@ class GetAFIPData(Wizard):
         Address = Pool().get('party.address')
         direccion = Address().search(['party', '=', party])
 
-        if len(direccion) > 0 and (direccion[0].street is None or direccion[0].street == ''):
+        if not (self.start.direccion or self.start.codigo_postal):
+            # without address (local snapshot): the current one is kept
+            pass
+        elif len(direccion) > 0 and (direccion[0].street is None or direccion[0].street == ''):
             self._update_direccion(direccion[0], party, self.start)
         else:
             direccion = Address()
@@ -288,12 +688,48 @@ class GetAFIPData(Wizard):
 
     @classmethod
     def get_json(self, vat_number):
-        try:
-            afip_url    = 'https://soa.afip.gob.ar/sr-padron/v2/persona/%s' % vat_number
-            afip_stream = urlopen(afip_url)
-            afip_json   = afip_stream.read()
-            afip_dict   = loads(afip_json)
-            print "   >>> got json:\n" + dumps(afip_dict)
-            return afip_dict['data']
-        except Exception:
-            self.raise_user_error('vat_number_not_found')
+        "Datos del padron de AFIP (None si el CUIT no existe), con cache"
+        AfipPadron = Pool().get('account_invoice_ar.afip_padron')
+        return AfipPadron.lookup(vat_number)
+
+
+class EnrichFromAFIPResult(ModelView):
+    'Enrich From AFIP Result'
+    __name__ = 'party.enrich_from_afip.result'
+    changed = fields.Integer('Actualizadas', readonly=True)
+    unchanged = fields.Integer('Sin cambios', readonly=True)
+    failed = fields.Integer('Fallidas', readonly=True)
+    detalle = fields.Text('Detalle', readonly=True)
+
+
+class EnrichFromAFIP(Wizard):
+    'Enrich From AFIP'
+    __name__ = 'party.enrich_from_afip'
+
+    start = StateTransition()
+    result = StateView('party.enrich_from_afip.result',
+        'account_invoice_ar.enrich_from_afip_result_view', [
+            Button('OK', 'end', 'tryton-ok', default=True),
+        ])
+
+    def transition_start(self):
+        Party = Pool().get('party.party')
+        parties = Party.browse(Transaction().context['active_ids'])
+        self.report = Party.enrich_from_afip(parties)
+        return 'result'
+
+    def default_result(self, fields):
+        report = self.report
+        detalle = []
+        for party in report['changed']:
+            detalle.append(u'Actualizada: %s (%s)' % (party.rec_name,
+                    party.vat_number))
+        for party, message in report['failed']:
+            detalle.append(u'Fallida: %s (%s): %s' % (party.rec_name,
+                    party.vat_number, message))
+        return {
+            'changed': len(report['changed']),
+            'unchanged': len(report['unchanged']),
+            'failed': len(report['failed']),
+            'detalle': u'\n'.join(detalle),
+            }
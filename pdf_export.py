@@ -0,0 +1,231 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the Affero GNU General Public License as published by
+# the Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+"Conversion of the invoice reports to PDF in a pool of office processes"
+
+__license__ = "AGPL 3.0"
+
+import atexit
+import hashlib
+import json
+import logging
+import os
+import Queue
+import resource
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+
+OFFICE = "soffice"          # office binary started as listener
+UNOCONV = "unoconv"         # converter client
+STARTUP_TIMEOUT = 60        # seconds to wait for an office to listen
+PROCESSES = 4               # office processes (documents converted at once)
+AHEAD = 2                   # documents rendered ahead for each process
+MANIFEST = "manifest.json"
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class OfficePool(object):
+    '''Office processes listening on free ports, started once (warm).
+
+    Each Tryton process has its own pool: the ports are taken from the
+    free ones when it starts, so the pools of several workers do not collide.
+    '''
+
+    def __init__(self, size=PROCESSES, timeout=STARTUP_TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self._processes = []
+        self._free = Queue.Queue()
+
+    def start(self):
+        devnull = open(os.devnull, "w")
+        ports = []
+        for _ in range(self.size):
+            port = get_free_port()
+            # each office needs its own profile to run at the same time
+            profile = tempfile.mkdtemp(prefix="office-")
+            process = subprocess.Popen([OFFICE, "--headless", "--invisible",
+                "--nologo", "--norestore",
+                "-env:UserInstallation=file://%s" % profile,
+                "--accept=%s" % self.get_connection(port)],
+                stdout=devnull, stderr=devnull)
+            self._processes.append((process, profile))
+            ports.append((port, process))
+        try:
+            for port, process in ports:
+                self._wait_ready(port, process)
+        except:
+            self.stop()
+            raise
+        for port, _ in ports:
+            self._free.put(port)
+
+    def _wait_ready(self, port, process):
+        "Wait until the office accepts connections on the port"
+        deadline = time.time() + self.timeout
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError("Office exited (%s) before listening on "
+                                   "port %d" % (process.returncode, port))
+            try:
+                socket.create_connection(('127.0.0.1', port), 1).close()
+                return
+            except socket.error:
+                if time.time() > deadline:
+                    raise RuntimeError("Office not listening on port %d "
+                                       "after %d s" % (port, self.timeout))
+                time.sleep(0.1)
+
+    def stop(self):
+        for process, profile in self._processes:
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+            shutil.rmtree(profile, ignore_errors=True)
+        self._processes = []
+        self._free = Queue.Queue()
+
+    def get_connection(self, port):
+        return "socket,host=127.0.0.1,port=%d;urp;StarOffice.ComponentContext" % (
+            port)
+
+    def convert(self, data, extension="odt", output="pdf"):
+        "Convert the document with the first office available"
+        port = self._free.get()
+        fd, path = tempfile.mkstemp(suffix="." + extension)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            process = subprocess.Popen([UNOCONV,
+                "--connection=%s" % self.get_connection(port),
+                "-f", output, "--stdout", path],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            stdout, stderr = process.communicate()
+            if process.returncode:
+                raise RuntimeError(stderr)
+            return stdout
+        finally:
+            os.unlink(path)
+            self._free.put(port)
+
+
+def get_free_port():
+    "Return a TCP port of the loopback not used now"
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def get_pool(size=PROCESSES):
+    "Return the office pool of the process (started on first use)"
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.size != size:
+            if _pool is not None:
+                _pool.stop()
+            _pool = OfficePool(size)
+            _pool.start()
+        return _pool
+
+
+@atexit.register
+def _stop_pool():
+    with _pool_lock:
+        if _pool is not None:
+            _pool.stop()
+
+
+def export(documents, directory, pool):
+    """Convert the documents to PDF in the directory and write a manifest.
+
+    documents yields dicts with id, name, extension, data and render (the
+    seconds taken to render it); they are converted while the next ones are
+    rendered, at most AHEAD per process are kept waiting. The files are named
+    by name and id (numbers repeat between voucher types). Returns the
+    summary: throughput, latency and memory.
+    """
+    logger = logging.getLogger('pdf_export')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    start = time.time()
+    window = threading.BoundedSemaphore(pool.size * (AHEAD + 1))
+
+    def convert(document):
+        begin = time.time()
+        entry = {
+            'id': document['id'],
+            'name': document['name'],
+            'render': document['render'],
+            }
+        try:
+            if document['extension'] == 'pdf':
+                pdf = document['data']
+            else:
+                pdf = pool.convert(document['data'], document['extension'])
+            fn = "%s-%s.pdf" % (os.path.basename(document['name']),
+                                document['id'])
+            with open(os.path.join(directory, fn), "wb") as f:
+                f.write(pdf)
+            entry.update(file=fn, size=len(pdf),
+                         sha1=hashlib.sha1(pdf).hexdigest())
+        except Exception, e:
+            logger.exception(u"Error converting %s", document['name'])
+            entry['error'] = unicode(e)
+        finally:
+            window.release()
+        entry['convert'] = time.time() - begin
+        return entry
+
+    threads = ThreadPool(pool.size)
+    try:
+        results = []
+        for document in documents:
+            # wait for a conversion before rendering more documents
+            window.acquire()
+            results.append(threads.apply_async(convert, (document,)))
+        entries = [result.get() for result in results]
+    finally:
+        threads.close()
+        threads.join()
+
+    elapsed = time.time() - start
+    latencies = sorted(e['render'] + e['convert'] for e in entries)
+    summary = {
+        'documents': len(entries),
+        'errors': len([e for e in entries if 'error' in e]),
+        'seconds': elapsed,
+        'throughput': len(entries) / elapsed if elapsed else 0,
+        'latency_avg': sum(latencies) / len(latencies) if latencies else 0,
+        'latency_p95': (latencies[int(len(latencies) * 0.95)]
+                        if latencies else 0),
+        'latency_max': latencies[-1] if latencies else 0,
+        # kilobytes (linux), the office processes are not included
+        'memory_max': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+    with open(os.path.join(directory, MANIFEST), "w") as f:
+        json.dump({'summary': summary, 'documents': entries}, f, indent=1)
+    logger.info(u"%(documents)d PDF (%(errors)d errores) en %(seconds).1fs: "
+                u"%(throughput).2f/s, demora promedio %(latency_avg).2fs "
+                u"(p95 %(latency_p95).2fs), memoria %(memory_max)d KB",
+                summary)
+    return summary
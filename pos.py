@@ -1,11 +1,19 @@
 #! -*- coding: utf8 -*-
 
+import datetime
+
+from trytond.cache import Cache
 from trytond.model import ModelView, ModelSQL, fields
 from trytond.pyson import Eval
 from trytond.pool import Pool
+from trytond.transaction import Transaction
 
 __all__ = ['Pos', 'PosSequence']
 
+# last number authorized by AFIP, known by this process:
+# (database, sequence id) -> (number, last check against AFIP)
+_LAST_CBTE = {}
+
 
 class Pos(ModelSQL, ModelView):
     'Point of Sale'
@@ -33,11 +41,36 @@ class Pos(ModelSQL, ModelView):
             'required': Eval('pos_type') == 'electronic',
             }, depends=['pos_type'],
         help=u"Habilita la facturación electrónica por webservices AFIP")
+    pyafipws_cae_mode = fields.Selection([
+            ('sync', u'Al contabilizar'),
+            ('queued', u'En cola'),
+            ], u'Solicitud de CAE',
+        states={
+            'invisible': Eval('pos_type') != 'electronic',
+            'required': Eval('pos_type') == 'electronic',
+            }, depends=['pos_type'],
+        help=u"En cola: la factura se contabiliza sin esperar a AFIP y el "
+            u"CAE se solicita luego, en segundo plano")
+    pyafipws_cbte_check_interval = fields.Integer(
+        u'Verificar numeración AFIP cada (minutos)',
+        states={
+            'invisible': Eval('pos_type') != 'electronic',
+            }, depends=['pos_type'],
+        help=u"Cada cuánto se consulta a AFIP el último comprobante "
+            u"autorizado. 0 para consultarlo en cada factura")
 
     @staticmethod
     def default_pos_type():
         return 'manual'
 
+    @staticmethod
+    def default_pyafipws_cae_mode():
+        return 'sync'
+
+    @staticmethod
+    def default_pyafipws_cbte_check_interval():
+        return 60
+
     @classmethod
     def get_name(cls, account_pos, name):
         res = {}
@@ -80,6 +113,79 @@ class PosSequence(ModelSQL, ModelView):
             'Sequence', required=True,
             domain=[('code', '=', 'account.invoice')],
             context={'code': 'account.invoice'}))
+    pyafipws_last_cbte_nro = fields.Integer(u'Último comprobante AFIP',
+        readonly=True,
+        help=u"Último número autorizado por AFIP para este tipo de comprobante")
+    pyafipws_last_cbte_check = fields.DateTime(u'Última verificación AFIP',
+        readonly=True,
+        help=u"Última vez que se consultó a AFIP el último comprobante")
+    # (point of sale id, AFIP voucher type) -> sequence ids
+    _sequences_cache = Cache('account_pos_sequence.get_sequences',
+        context=False)
+
+    @classmethod
+    def get_sequences(cls, pos, invoice_type):
+        "Return the ids of the sequences of the point of sale and voucher type"
+        index = cls._sequences_cache.get(None)
+        if index is None:
+            index = {}
+            for sequence in cls.search([]):
+                key = (sequence.pos and sequence.pos.id, sequence.invoice_type)
+                index.setdefault(key, []).append(sequence.id)
+            cls._sequences_cache.set(None, index)
+        return index.get((pos, invoice_type), [])
+
+    @classmethod
+    def create(cls, vlist):
+        cls._sequences_cache.clear()
+        return super(PosSequence, cls).create(vlist)
+
+    @classmethod
+    def write(cls, sequences, values, *args):
+        # the last authorized number is written often, keep the index then
+        actions = iter((sequences, values) + args)
+        for _, values in zip(actions, actions):
+            if 'pos' in values or 'invoice_type' in values:
+                cls._sequences_cache.clear()
+                break
+        super(PosSequence, cls).write(sequences, values, *args)
+
+    @classmethod
+    def delete(cls, sequences):
+        cls._sequences_cache.clear()
+        super(PosSequence, cls).delete(sequences)
+
+    def get_pyafipws_last_cbte(self):
+        "Return the last authorized number, None if AFIP must be queried"
+        key = (Transaction().cursor.database_name, self.id)
+        number, checked = _LAST_CBTE.get(key,
+            (self.pyafipws_last_cbte_nro, self.pyafipws_last_cbte_check))
+        if number is None or checked is None:
+            return None
+        interval = self.pos.pyafipws_cbte_check_interval
+        if (not interval or checked + datetime.timedelta(minutes=interval)
+                < datetime.datetime.now()):
+            return None
+        return number
+
+    def set_pyafipws_last_cbte(self, number, checked=False):
+        '''
+        Store the last number authorized by AFIP.
+        number None forces a query to AFIP on the next invoice.
+        It must be called within a new cursor, so it survives a rollback.
+        '''
+        key = (Transaction().cursor.database_name, self.id)
+        last_number, last_checked = _LAST_CBTE.get(key,
+            (self.pyafipws_last_cbte_nro, self.pyafipws_last_cbte_check))
+        if number is None:
+            last_checked = None
+        elif checked:
+            last_checked = datetime.datetime.now()
+        _LAST_CBTE[key] = (number, last_checked)
+        self.write([self], {
+                'pyafipws_last_cbte_nro': number,
+                'pyafipws_last_cbte_check': last_checked,
+                })
 
     def get_rec_name(self, name):
         type2name = {}
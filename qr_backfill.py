@@ -0,0 +1,151 @@
+#! -*- coding: utf8 -*-
+#This file is part of Tryton.  The COPYRIGHT file at the top level of
+#this repository contains the full copyright notices and license terms.
+
+import logging
+
+from trytond.model import ModelView, ModelSQL, ModelSingleton, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from . import afip_qr
+
+__all__ = ['QrBackfill']
+
+CHUNK_SIZE = 500            # invoices read and written at once
+MAX_CHUNKS = 20             # chunks processed by each call of the cron
+
+
+class QrBackfill(ModelSingleton, ModelSQL, ModelView):
+    'QR Code Backfill'
+    __name__ = 'account_invoice_ar.qr_backfill'
+
+    last_invoice = fields.Integer(u'Última factura procesada', readonly=True)
+    processed = fields.Integer('Procesadas', readonly=True)
+    pending = fields.Function(fields.Integer('Pendientes'), 'get_pending')
+
+    @classmethod
+    def __setup__(cls):
+        super(QrBackfill, cls).__setup__()
+        cls._buttons.update({
+            'run': {},
+            'restart': {},
+            })
+
+    @staticmethod
+    def default_last_invoice():
+        return 0
+
+    @staticmethod
+    def default_processed():
+        return 0
+
+    @staticmethod
+    def _get_domain(last_invoice):
+        return [
+            ('type', 'in', ['out_invoice', 'out_credit_note']),
+            ('state', 'in', ['posted', 'paid']),
+            ('pyafipws_cae', '!=', None),
+            ('pos.pos_type', '=', 'electronic'),
+            ('id', '>', last_invoice),
+            ]
+
+    def get_pending(self, name):
+        Invoice = Pool().get('account.invoice')
+        return Invoice.search_count(self._get_domain(self.last_invoice or 0))
+
+    @classmethod
+    def get_backfill(cls):
+        backfill = cls.get_singleton()
+        if backfill is None:
+            backfill, = cls.create([{}])
+        return backfill
+
+    @classmethod
+    @ModelView.button
+    def run(cls, backfills):
+        cls.process()
+
+    @classmethod
+    @ModelView.button
+    def restart(cls, backfills):
+        "Process again all the invoices (i.e. after a fix of the QR code)"
+        cls.write(backfills, {
+                'last_invoice': 0,
+                'processed': 0,
+                })
+
+    @classmethod
+    def process(cls):
+        '''
+        Create (or fix) the QR code of the posted electronic invoices (cron).
+        The invoices are processed in id order and chunks, each one in its
+        own cursor committed with the checkpoint, so the next call resumes
+        from there and the transaction of the caller is not committed.
+        '''
+        for _ in xrange(MAX_CHUNKS):
+            with Transaction().new_cursor():
+                if not cls._process_next_chunk():
+                    break
+                Transaction().cursor.commit()
+
+    @classmethod
+    def _process_next_chunk(cls):
+        "Process the invoices after the checkpoint, return False when done"
+        Invoice = Pool().get('account.invoice')
+        logger = logging.getLogger('pyafipws')
+
+        backfill = cls.get_backfill()
+        total = (backfill.processed or 0) + backfill.pending
+        invoices = Invoice.search(cls._get_domain(backfill.last_invoice or 0),
+            order=[('id', 'ASC')], limit=CHUNK_SIZE)
+        if not invoices:
+            return False
+        cls._process_chunk(invoices)
+        processed = (backfill.processed or 0) + len(invoices)
+        cls.write([backfill], {
+                'last_invoice': invoices[-1].id,
+                'processed': processed,
+                })
+        logger.info(u'Códigos QR: %d/%d facturas (hasta id %d)',
+            processed, total, invoices[-1].id)
+        return True
+
+    @classmethod
+    def _process_chunk(cls, invoices):
+        "Encode the QR codes (in-process, they are fast) and write them at once"
+        Invoice = Pool().get('account.invoice')
+        logger = logging.getLogger('pyafipws')
+
+        data = []
+        for invoice in invoices:
+            try:
+                data.append(invoice.get_qr_data())
+            except (TypeError, ValueError, AttributeError):
+                logger.warning(u'No se pudo generar el código QR de la '
+                    u'factura %s', invoice.number, exc_info=True)
+                data.append(None)
+        args = []
+        for invoice, result in zip(invoices, map(encode_qr, data)):
+            if result is None:
+                continue
+            payload, url = result
+            if (invoice.qr_codigo, invoice.qr_texto_modificado) == result:
+                continue
+            args.extend(([invoice], {
+                        'qr_codigo': payload,
+                        'qr_texto_modificado': url,
+                        }))
+        if args:
+            Invoice.write(*args)
+
+
+def encode_qr(data):
+    "Return the QR payload and url of the invoice data"
+    if data is None:
+        return None
+    payload, url = afip_qr.encode(data)
+    if afip_qr.CACHE_DIR:
+        # leave the image rendered for the reports
+        afip_qr.get_image(url)
+    return payload, url
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the Affero GNU General Public License as published by
+# the Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+
+"Labels printed by the invoice report, indexed once by selection value"
+
+__license__ = "AGPL 3.0"
+
+from collections import namedtuple
+
+
+# u'01-Factura A' -> code u'01', name u'Factura', letter u'A'
+InvoiceTypeLabel = namedtuple('InvoiceTypeLabel', ['code', 'letter', 'name'])
+EMPTY = InvoiceTypeLabel(u'', u'', u'')
+
+
+class LabelIndex(object):
+    "Immutable lookup of the invoice type and IVA condition labels"
+    __slots__ = ('_invoice_types', '_iva_conditions')
+
+    def __init__(self, invoice_types, iva_conditions):
+        """invoice_types and iva_conditions are the selection lists of
+        account.pos.sequence invoice_type and party.party iva_condition"""
+        object.__setattr__(self, '_invoice_types', dict(
+            (value, InvoiceTypeLabel(label[:2], label[-1], label[3:-2])
+                if label else EMPTY)
+            for value, label in invoice_types))
+        object.__setattr__(self, '_iva_conditions', dict(iva_conditions))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("LabelIndex is immutable")
+
+    def invoice_type(self, value):
+        "Return the InvoiceTypeLabel (code, letter, name) of the value"
+        if not value:
+            return EMPTY
+        return self._invoice_types[value]
+
+    def iva_condition(self, value):
+        return self._iva_conditions[value]
+
+
+if __name__ == '__main__':
+    # benchmark: labels of a large set of invoices, with the labels of each
+    # selection field cached in a dict (as the report helpers did) and with
+    # the index
+    import sys
+    import timeit
+    invoice_types = [('', ''), ('1', u'01-Factura A'), ('3', u'03-Nota de '
+        u'Crédito A'), ('6', u'06-Factura B'), ('8', u'08-Nota de Crédito B'),
+        ('11', u'11-Factura C'), ('19', u'19-Factura E')] + [
+        (str(i), u'%02d-Comprobante X' % i) for i in range(22, 40)]
+    iva_conditions = [('', ''), ('responsable_inscripto',
+        'Responsable Inscripto'), ('exento', 'Exento'), ('consumidor_final',
+        'Consumidor Final'), ('monotributo', 'Monotributo')]
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    invoices = [(invoice_types[1 + i % 6][0],
+                 iva_conditions[1 + i % 4][0]) for i in range(number)]
+
+    selection_labels = {}
+
+    def get_selection(model, field):
+        key = (model, field)
+        if key not in selection_labels:
+            selection_labels[key] = dict(invoice_types
+                if field == 'invoice_type' else iva_conditions)
+        return selection_labels[key]
+
+    def selection():
+        for invoice_type, iva_condition in invoices:
+            # tipo, nombre and codigo_comprobante sliced the label each time
+            get_selection('account.pos.sequence',
+                          'invoice_type')[invoice_type][-1]
+            get_selection('account.pos.sequence',
+                          'invoice_type')[invoice_type][3:-2]
+            get_selection('account.pos.sequence',
+                          'invoice_type')[invoice_type][:2]
+            # show_tax and invoice_impuestos looked it up again
+            get_selection('account.pos.sequence',
+                          'invoice_type')[invoice_type][-1]
+            get_selection('account.pos.sequence',
+                          'invoice_type')[invoice_type][-1]
+            get_selection('party.party', 'iva_condition')[iva_condition]
+
+    index = LabelIndex(invoice_types, iva_conditions)
+
+    def indexed():
+        for invoice_type, iva_condition in invoices:
+            index.invoice_type(invoice_type)
+            index.iva_condition(iva_condition)
+
+    for name, function in [('selection dict', selection),
+                           ('LabelIndex', indexed)]:
+        seconds = timeit.timeit(function, number=1)
+        print "%-16s %8.3f s %8.2f us/invoice" % (name, seconds,
+                                                 seconds * 1e6 / number)
@@ -33,6 +33,8 @@ for dep in info.get('depends', []):
 
 requires.append('trytond >= %s.%s, < %s.%s' %
         (major_version, minor_version, major_version, minor_version + 1))
+# QR code of the electronic invoices (afip_qr)
+requires.append('PyQRCode >= 1.2')
 
 setup(name='account_invoice_ar',
     version=info.get('version', '0.0.1'),